@@ -0,0 +1,9 @@
+"""
+Modules of the SchoolAppServer management tool. The command line interface
+is started by the script school_app_server.py.
+
+Heavy modules (yaml, bcrypt, argon2, python_on_whales, prompt_toolkit and
+prometheus_client) are imported inside the functions that need them, so that
+short code paths like "--version" or single commands from the command line
+start quickly.
+"""
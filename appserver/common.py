@@ -0,0 +1,357 @@
+"""
+Shared state and helpers of all modules: constants, the options of the
+running instance, output, logging of structured events and writing files
+atomically.
+"""
+
+import os
+import sys
+import json
+import functools
+import fnmatch
+import time
+try:
+    import tomllib
+except ModuleNotFoundError:
+    # fall back if Python version does not include tomllib
+    import tomli as tomllib
+import tempfile
+import logging
+import logging.handlers
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+
+# create logger instance
+logger = logging.getLogger('school_app_server')
+# create logger for structured events about all operations (start, stop, pull, setup, ...)
+event_logger = logging.getLogger('school_app_server.events')
+# operations and steps currently running in each thread, used as parents for recorded events
+operation_context = threading.local()
+
+APP = 'SchoolAppServer'
+VERSION = '2.0'
+INITIAL_SETUP_MARKER_FILE = '.initialized'
+DEFAULT_MAX_WORKERS = 4
+EVENTS_LOG_FILE = 'SchoolAppServer.events.jsonl'
+# the umask can only be read by setting it, which affects all threads of the process,
+# so it is read once on import before any thread is started
+UMASK = os.umask(0o022)
+os.umask(UMASK)
+
+# stacks that provide resources for all other stacks (e.g. Traefik network, identity provider)
+# and therefore have to be started first and in this order
+STARTUP_ORDER = ['infrastructure', 'identity-provider']
+
+app_name_map = {'infrastructure': 'Infrastructure Services (Traefik, Portainer, Uptime Kuma, Watchtower)',
+                'identity-provider': 'Authentik - An open-source identity provider and user management',
+                'grafana': 'Grafana - Create, explore, and share data through beautiful, flexible dashboards',
+                'nextcloud': 'Nextcloud - Self hosted open source cloud file storage',
+                'kanboard': 'Kanboard - Free and open source Kanban project management software',
+                'moodle': 'Moodle - Open Source Learning Management System',
+                'etherpad': 'Etherpad - Real-time collaborative editor for the web',
+                'hedgedoc': 'HedgeDoc - An open-source, web-based, self-hosted, collaborative markdown editor',
+                'drawio': 'draw.io - Web-based application for creating diagrams and flowcharts',
+                'jenkins': 'Jenkins - An open source automation server for CI/CD',
+                'gitea': 'Gitea - Open Source Self-Hosted Git Service', 'wekan': 'WeKan - Open-Source Kanban',
+                'jupyter-lab': 'Jupyter Notebook Scientific Python Stack',
+                'node-red': 'Node-RED - Low-code programming for event-driven applications',
+                'collabora': 'Collabora Online Development Edition - A online office suite',
+                'onlyoffice': 'OnlyOffice - A free and open source office and productivity suite',
+                'teammapper': 'TeamMapper - Online tool to create and collaborate on mindmaps',
+                'mattermost': 'Mattermost - Open-source, self-hostable online chat service with file sharing',
+                'vaultwarden': 'Vaultwarden - Community driven web-based Bitwarden compatible password manager server',
+                'kiwix': 'Kiwix - Provides offline access to free educational content',
+                'hesk': 'Help Desk Software HESK',
+                'tools': 'Tools (Stirling PDF)', 'static': 'Landing Pages (Heimdall, Homer)',
+                'dashy': 'Dashy - A self-hostable personal dashboard built for you',
+                'opencart': 'OpenCart - Open Source Shopping Cart Solution (not yet working!)',
+                'phpmyadmin': 'phpMyAdmin - Web interface for MySQL and MariaDB (not yet working!)',
+                'stalwart': 'Stalwart - All-in-one Mail & Collaboration server supporting every protocol',
+                'immich': 'Immmich - High performance self-hosted photo and video management solution.'}
+
+basic_configuration = {}
+answers = {}
+# state of the running instance: options given on the command line as well as
+# clients and caches that are created on first use
+runtime = SimpleNamespace(max_workers=None, docker_backend=None, compose_index=None, engine_client=None,
+                          status_cache=None, interactive=True, missing_answers=[])
+
+
+def print_formatted(*args, **kwargs):
+    """
+    Prints formatted text with prompt_toolkit, which is imported on first use.
+    Plain strings are printed directly, so that commands without formatted
+    output do not import prompt_toolkit at all.
+    """
+    if all(isinstance(arg, str) for arg in args):
+        # flush, so that the output keeps its order with the output of prompt_toolkit
+        print(*args, flush=True, **kwargs)
+        return
+    from prompt_toolkit import print_formatted_text  # pylint: disable=import-outside-toplevel
+    print_formatted_text(*args, **kwargs)
+
+
+def HTML(value):  # pylint: disable=invalid-name
+    """Creates formatted text from HTML with prompt_toolkit, which is imported on first use."""
+    from prompt_toolkit import HTML as FormattedHTML  # pylint: disable=import-outside-toplevel
+    return FormattedHTML(value)
+
+
+def create_logger():
+    """Creates and configures a logger for logging to file and stdout."""
+    logger.setLevel(logging.DEBUG)
+    log_to_file = logging.handlers.RotatingFileHandler(
+        'SchoolAppServer.log', maxBytes=262144, backupCount=5)
+    log_to_file.setLevel(logging.DEBUG)
+    logger.addHandler(log_to_file)
+    log_to_screen = logging.StreamHandler(sys.stdout)
+    log_to_screen.setLevel(logging.WARN)
+    logger.addHandler(log_to_screen)
+    event_logger.setLevel(logging.INFO)
+    event_logger.propagate = False
+    events_to_file = logging.handlers.RotatingFileHandler(
+        EVENTS_LOG_FILE, maxBytes=1048576, backupCount=5)
+    event_logger.addHandler(events_to_file)
+
+
+def get_operation_stack():
+    """Returns the operations and steps that are currently running in this thread."""
+    if not hasattr(operation_context, 'stack'):
+        operation_context.stack = []
+    return operation_context.stack
+
+
+def record_event(operation, app=None, duration=None, success=True, **details):
+    """
+    Records an operation as structured event (JSON) in the events log. If the
+    event belongs to a step of another operation, the name of that operation
+    is added as parent. The events are evaluated by the metrics exporter and
+    the command "report" and can also be shipped to Loki.
+    """
+    event = {'time': datetime.now(timezone.utc).isoformat(), 'operation': operation, 'app': app,
+             'duration': round(duration, 3) if duration is not None else None, 'success': success}
+    if get_operation_stack():
+        event['parent'] = get_operation_stack()[-1]
+    event.update(details)
+    event_logger.info(json.dumps(event))
+
+
+@contextmanager
+def timed_step(step, app=None, **details):
+    """
+    Measures the duration of an operation or a step of it, e.g. parsing a
+    compose file or calling Docker Compose, and records it as event. The
+    step has failed, if an exception is raised.
+    """
+    start_time = time.monotonic()
+    success = False
+    get_operation_stack().append(step)
+    try:
+        yield
+        success = True
+    finally:
+        get_operation_stack().pop()
+        record_event(step, app, time.monotonic() - start_time, success, **details)
+
+
+def recorded_operation(operation):
+    """
+    Decorator for functions handling a single app that records duration and
+    success of every call as event. The decorated function has to get the
+    app as second argument and return whether it has been successful.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(docker_clients, app, *args, **kwargs):
+            start_time = time.monotonic()
+            success = False
+            get_operation_stack().append(operation)
+            try:
+                success = function(docker_clients, app, *args, **kwargs)
+                return success
+            finally:
+                get_operation_stack().pop()
+                record_event(operation, app, time.monotonic() - start_time, bool(success))
+        return wrapper
+    return decorator
+
+
+class FileTransaction:
+    """
+    Writes a group of files all together or not at all. Every file is first
+    written to a temporary file in the same directory and synced to disk.
+    When the transaction is committed, all temporary files are renamed to
+    their final names. If anything fails, all temporary files are removed and
+    the files that have already been replaced get their previous content back.
+    The transaction can be used as context manager, which commits on success
+    and rolls back on any exception.
+    """
+
+    def __init__(self):
+        self.staged = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    def write(self, filename, content):
+        """
+        Writes the content (text or bytes) for a file into a temporary file
+        until the transaction is committed.
+        """
+        path = Path(filename)
+        fd, temp_name = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+        self.staged.append((temp_name, path))
+        mode, encoding = ('wb', None) if isinstance(content, bytes) else ('w', 'utf-8')
+        with os.fdopen(fd, mode, encoding=encoding) as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        if path.exists():
+            mode = path.stat().st_mode & 0o777
+        else:
+            # use the same permissions as a file created by open()
+            mode = 0o666 & ~UMASK
+        os.chmod(temp_name, mode)
+
+    def commit(self):
+        """
+        Renames all temporary files to their final names and syncs their
+        directories to disk, so that the new names survive a crash.
+        """
+        replaced = []
+        try:
+            for temp_name, path in self.staged:
+                previous_content = path.read_bytes() if path.exists() else None
+                os.replace(temp_name, path)
+                replaced.append((path, previous_content))
+            for directory in {path.parent for _, path in self.staged}:
+                fsync_directory(directory)
+        except BaseException:
+            self.rollback()
+            self.restore(replaced)
+            raise
+        self.staged = []
+
+    @staticmethod
+    def restore(replaced):
+        """
+        Gives all replaced files their previous content back. The previous
+        content is written atomically as well, files that did not exist before
+        are removed.
+        """
+        with FileTransaction() as transaction:
+            for path, previous_content in reversed(replaced):
+                if previous_content is None:
+                    path.unlink(missing_ok=True)
+                else:
+                    transaction.write(path, previous_content)
+        for directory in {path.parent for path, previous_content in replaced if previous_content is None}:
+            fsync_directory(directory)
+
+    def rollback(self):
+        """Removes all temporary files, so that no file is changed."""
+        for temp_name, _ in self.staged:
+            Path(temp_name).unlink(missing_ok=True)
+        self.staged = []
+
+
+def fsync_directory(path):
+    """Syncs a directory to disk, so that files renamed or removed in it survive a crash."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_file_atomically(filename, content):
+    """
+    Writes content to a file atomically by writing to a temporary file in the
+    same directory, syncing it to disk and renaming it to the final name.
+    """
+    with FileTransaction() as transaction:
+        transaction.write(filename, content)
+
+
+def get_short_error_message(exception):
+    """Returns the last line of the error output of a failed Docker command."""
+    lines = str(getattr(exception, 'stderr', None) or exception).strip().splitlines()
+    return lines[-1] if lines else 'unknown error'
+
+
+def get_max_workers():
+    """Returns the maximum number of stacks that are handled concurrently."""
+    if runtime.max_workers:
+        return runtime.max_workers
+    return int(basic_configuration.get('max-workers', DEFAULT_MAX_WORKERS))
+
+
+def check_if_initial_setup_completed(app=None):
+    """Checks whether initial setup has been executed."""
+    if app:
+        if (Path(app) / INITIAL_SETUP_MARKER_FILE).is_file():
+            return True
+    else:
+        if Path(INITIAL_SETUP_MARKER_FILE).is_file():
+            return True
+    return False
+
+
+def load_answers(filename):
+    """
+    Loads answers for all questions asked during setup from a TOML file. The
+    basic configuration is given by the top-level keys "mail-address" and
+    "domain-name". Values for each app are given in a table named after the
+    app, containing the names of placeholders from the .env.template file or
+    the names of secret files (without extension) as keys.
+    """
+    with open(filename, 'rb') as f:
+        loaded = tomllib.load(f)
+    # update the dictionary in place, because it is shared by all modules
+    answers.clear()
+    answers.update(loaded)
+    logger.debug('Loaded answers from file: %s', filename)
+
+
+def load_basic_configuration():
+    """Loads basic configuration from file."""
+    try:
+        with open(Path(INITIAL_SETUP_MARKER_FILE), 'rb') as f:
+            loaded = tomllib.load(f)
+        # update the dictionary in place, because it is shared by all modules
+        basic_configuration.clear()
+        basic_configuration.update(loaded)
+    except FileNotFoundError:
+        logger.debug('Could not find basic configuration file.')
+
+
+def select_apps(args):
+    """
+    Returns all apps selected by the given arguments. Either "all", names of
+    apps or glob patterns like "grafana*" can be given. Arguments starting
+    with "!" exclude the matching apps, e.g. "!jupyter-lab". If only
+    exclusions are given, they are applied to all apps. If an argument does
+    not match any app, None is returned.
+    """
+    includes = [arg for arg in args if not arg.startswith('!')]
+    excludes = [arg[1:] for arg in args if arg.startswith('!')]
+    unknown_patterns = [p for p in includes + excludes if p != 'all' and not fnmatch.filter(app_name_map, p)]
+    if unknown_patterns:
+        print_formatted(HTML('<red>Given app not available: {}</red>').format(', '.join(unknown_patterns)))
+        return None
+    if not includes or 'all' in includes:
+        apps = list(app_name_map)
+    else:
+        apps = [app for app in app_name_map if any(fnmatch.fnmatch(app, p) for p in includes)]
+    return [app for app in apps if not any(fnmatch.fnmatch(app, p) for p in excludes)]
@@ -0,0 +1,237 @@
+"""
+Reads the Docker Compose files and .env files of all apps. The results of
+parsing the Docker Compose files are cached in an index on disk.
+"""
+
+import re
+import json
+import threading
+import subprocess
+from pathlib import Path
+
+from .common import logger, runtime, timed_step, write_file_atomically
+
+
+COMPOSE_INDEX_FILE = '.compose_index.json'
+
+
+class ComposeIndex:
+    """
+    Parses the Docker Compose file of each stack only once and caches the
+    secrets, services, images, volumes and labels defined there. An entry is
+    parsed again, when modification time or size of the file have changed.
+    Also the config hashes of all services calculated by Docker Compose are
+    cached for every entry. The index can be persisted to a file, so that it
+    can be reused by later runs.
+    """
+
+    def __init__(self, cache_file=None):
+        self.cache_file = Path(cache_file) if cache_file else None
+        self.entries = None
+        self.modified = False
+        self.lock = threading.Lock()
+
+    def _load(self):
+        """Loads all entries from the cache file, if it exists."""
+        self.entries = {}
+        if self.cache_file and self.cache_file.is_file():
+            try:
+                with open(self.cache_file, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.debug('Could not load compose index from file %s: %s', self.cache_file, e)
+
+    def save(self):
+        """Writes all entries to the cache file, if anything has changed."""
+        with self.lock:
+            if not self.cache_file or not self.modified:
+                return
+            try:
+                write_file_atomically(self.cache_file, json.dumps(self.entries))
+                self.modified = False
+            except OSError as e:
+                logger.debug('Could not save compose index to file %s: %s', self.cache_file, e)
+
+    @staticmethod
+    def _parse(path, stat):
+        """Parses a Docker Compose file and extracts all relevant information."""
+        import yaml  # pylint: disable=import-outside-toplevel
+        with open(path, 'r', encoding='utf-8') as f:
+            data = yaml.safe_load(f) or {}
+        services = {}
+        for service, config in (data.get('services') or {}).items():
+            config = config or {}
+            labels = config.get('labels') or {}
+            if isinstance(labels, list):
+                labels = dict(label.split('=', 1) if '=' in label else (label, '') for label in labels)
+            resources = (config.get('deploy') or {}).get('resources') or {}
+            memory = ((resources.get('reservations') or {}).get('memory') or config.get('mem_reservation')
+                      or (resources.get('limits') or {}).get('memory') or config.get('mem_limit'))
+            services[service] = {
+                'image': config.get('image'),
+                'memory': parse_memory_size(memory),
+                'labels': labels,
+                'volumes': [v if isinstance(v, str) else v.get('source', '') for v in config.get('volumes') or []],
+                'secrets': [s if isinstance(s, str) else s.get('source', '') for s in config.get('secrets') or []],
+            }
+        return {
+            'mtime': stat.st_mtime, 'size': stat.st_size, 'name': data.get('name'),
+            'secrets': {s: (c or {}).get('file') for s, c in (data.get('secrets') or {}).items()},
+            'services': services, 'volumes': list(data.get('volumes') or {}),
+        }
+
+    def get(self, app):
+        """Returns the cached information of the Docker Compose file of an app or None if it does not exist."""
+        path = Path(app) / 'docker-compose.yml'
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            entry = self.entries.get(app)
+            if entry and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+                return entry
+        logger.debug('Parsing Docker Compose file: %s', path)
+        with timed_step('parse_compose', app):
+            entry = self._parse(path, stat)
+        with self.lock:
+            self.entries[app] = entry
+            self.modified = True
+        return entry
+
+    def get_config_hashes(self, app):
+        """
+        Returns the config hashes of all services of an app. They are only
+        calculated again by Docker Compose, when the Docker Compose file or
+        the .env file of the app have changed.
+        """
+        entry = self.get(app)
+        stat = (Path(app) / '.env').stat()
+        env_key = [stat.st_mtime, stat.st_size]
+        cached = entry.get('config_hashes') if entry else None
+        if cached and cached['env'] == env_key:
+            return cached['hashes']
+        with timed_step('config_hashes', app):
+            hashes = query_config_hashes(app)
+        with self.lock:
+            entry['config_hashes'] = {'env': env_key, 'hashes': hashes}
+            self.modified = True
+        return hashes
+
+
+def parse_memory_size(value):
+    """
+    Parses a memory size like "512m", "2GB" or a number of bytes as used in
+    Docker Compose files into bytes. Returns None if no valid size is given.
+    """
+    if value is None:
+        return None
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*', str(value).lower())
+    if not match:
+        logger.debug('Invalid memory size: %s', value)
+        return None
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** ' kmgt'.index(unit or ' '))
+
+
+def get_compose_index():
+    """Returns the index of all Docker Compose files, which is created on first use."""
+    if runtime.compose_index is None:
+        runtime.compose_index = ComposeIndex(COMPOSE_INDEX_FILE)
+    return runtime.compose_index
+
+
+def find_all_secrets(given_app=None):
+    """
+    Finds all secrets defined in the Docker Compose files of each stack or
+    only of a given app.
+    """
+    all_secrets = []
+    for path in Path('.').glob('*/docker-compose.yml'):
+        app = str(path.parent)
+        if given_app and app != given_app:
+            continue
+        entry = get_compose_index().get(app)
+        all_secrets.extend([(app, filename) for filename in entry['secrets'].values() if filename])
+    return all_secrets
+
+
+def read_env_file(app):
+    """Reads all environment variables from the .env file of a given app."""
+    variables = {}
+    env_file = Path(app) / '.env'
+    if not env_file.is_file():
+        return variables
+    with open(env_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            name, value = line.split('=', 1)
+            variables[name.strip()] = value.strip().strip('\'"')
+    return variables
+
+
+def expand_variables(text, variables):
+    """
+    Replaces all variables in a given string like Docker Compose does
+    ($VAR, ${VAR}, ${VAR:-default} and ${VAR-default}).
+    """
+    def replace(match):
+        name = match.group('braced') or match.group('named')
+        value = variables.get(name)
+        if match.group('default') is not None:
+            if value is None or (not value and match.group('colon')):
+                return match.group('default')
+        return value if value is not None else ''
+    pattern = r'\$(?:\{(?P<braced>\w+)(?:(?P<colon>:?)-(?P<default>[^}]*))?\}|(?P<named>\w+))'
+    return re.sub(pattern, replace, text)
+
+
+def find_service_images(app):
+    """
+    Finds the images of all services of an app. Variables inside the Docker
+    Compose file are replaced by their values from the .env file of the app.
+    Images without tag are normalized to the tag "latest".
+    """
+    service_images = {}
+    variables = read_env_file(app)
+    for service, config in get_compose_index().get(app)['services'].items():
+        if not config['image']:
+            continue
+        image = expand_variables(config['image'], variables).strip()
+        if not image:
+            logger.warning('Could not determine image of service %s in app %s.', service, app)
+            continue
+        if ':' not in image.rsplit('/', 1)[-1] and '@' not in image:
+            image = f'{image}:latest'
+        service_images[service] = image
+    return service_images
+
+
+def find_all_images(apps):
+    """
+    Finds all images used by the given apps. Returns a map with every image
+    and the apps that use it, so that every image is only listed once.
+    """
+    all_images = {}
+    for app in apps:
+        for image in find_service_images(app).values():
+            if app not in all_images.setdefault(image, []):
+                all_images[image].append(app)
+    return all_images
+
+
+def query_config_hashes(app):
+    """
+    Returns the hash of the configuration of every service of an app as it
+    is calculated by Docker Compose. Docker Compose stores this hash as label
+    on every container, so that it recreates containers whose configuration
+    has changed.
+    """
+    command = ['docker', 'compose', '--file', str(Path(app) / 'docker-compose.yml'),
+               '--env-file', str(Path(app) / '.env'), 'config', '--hash', '*']
+    output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+    return dict(line.split(maxsplit=1) for line in output.splitlines() if ' ' in line.strip())
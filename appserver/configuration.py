@@ -0,0 +1,666 @@
+"""
+Sets up the configuration of all apps: answers and passwords, secret files,
+placeholders in configuration files and the .env files generated from the
+.env.template files.
+"""
+
+import re
+import os
+import json
+import hashlib
+import time
+import string
+import secrets
+import tempfile
+from pathlib import Path
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from .common import (FileTransaction, HTML, INITIAL_SETUP_MARKER_FILE, answers, basic_configuration,
+                     check_if_initial_setup_completed, fsync_directory, logger, print_formatted, record_event, runtime,
+                     timed_step, write_file_atomically)
+from .compose_files import find_all_secrets
+
+
+ENV_FILE_TEMPLATE_FILENAME = '.env.template'
+SETUP_MANIFEST_FILENAME = '.setup_manifest.json'
+EXAMPLE_MAIL_PLACEHOLDER = 'mail@example.com'
+PLACEHOLDER_INDEX_FILE = '.placeholder_index.json'
+
+SUBDOMAIN_MAP = {
+    'UPTIMEKUMA_DOMAIN': 'status',
+    'TRAEFIK_DASHBOARD_DOMAIN': 'dashboard',
+    'TRAEFIK_METRICS_DOMAIN': 'metrics',
+    'PORTAINER_DOMAIN': 'portainer',
+    'NEXTCLOUD_DOMAIN': 'nextcloud',
+    'KANBOARD_DOMAIN': 'kanboard',
+    'STIRLINGPDF_DOMAIN': 'pdf',
+    'MOODLE_DOMAIN': 'moodle',
+    'HEIMDALL_DOMAIN': 'www',
+    'HOMER_DOMAIN': 'homer',
+    'DEFAULTPAGE_DOMAIN': 'static',
+    'ETHERPAD_DOMAIN': 'pad',
+    'HEDGEDOC_DOMAIN': 'md',
+    'DRAWIO_DOMAIN': 'draw',
+    'ONLYOFFICE_DOMAIN': 'onlyoffice',
+    'JENKINS_DOMAIN': 'jenkins',
+    'GITEA_DOMAIN': 'git',
+    'WEKAN_DOMAIN': 'wekan',
+    'OPENCART_DOMAIN': 'opencart',
+    'PHPMYADMIN_DOMAIN': 'phpmyadmin',
+    'JUPYTER_DOMAIN': 'jupyter',
+    'COLLABORA_DOMAIN': 'collabora',
+    'COLLABORA_NEXTCLOUD_DOMAIN': 'nextcloud',
+    'MATTERMOST_DOMAIN': 'mm',
+    'NODE_RED_DOMAIN': 'nodered',
+    'VAULTWARDEN_DOMAIN': 'vaultwarden',
+    'TEAMMAPPER_DOMAIN': 'teammapper',
+    'GRAFANA_DOMAIN': 'grafana',
+    'INFLUX_DOMAIN': 'influx',
+    'CHRONOGRAF_DOMAIN': 'chronograf',
+    'PROMETHEUS_DOMAIN': 'prometheus',
+    'LOKI_DOMAIN': 'loki',
+    'ALLOY_DOMAIN': 'alloy',
+    'AUTHENTIK_DOMAIN': 'auth',
+    'KIWIX_DOMAIN': 'kiwix',
+    'HESK_DOMAIN': 'hesk',
+    'DASHY_DOMAIN': 'dash',
+    'STALWART_DOMAIN': 'mail',
+    'STALWART_BASE_DOMAIN': '',
+    'AUTHENTIK_BASEDOMAIN': '',
+    'HEDGEDOC_OAUTH2_DOMAIN': 'auth',
+    'IMMICH_DOMAIN': 'images'
+}
+
+# a password hash that has to be calculated, the result is formatted with the given template
+HashJob = namedtuple('HashJob', ['function', 'args', 'template'])
+
+# a line of a .env.template file with the names of its placeholders and a pattern to read their values
+EnvVariable = namedtuple('EnvVariable', ['name', 'line', 'placeholders', 'pattern'])
+# a placeholder of a .env.template file with its kind (domain, secret, hashed-secret or input) and
+# its default value (the subdomain for domains)
+EnvPlaceholder = namedtuple('EnvPlaceholder', ['name', 'kind', 'default'])
+# a compiled .env.template file with all problems found while compiling it
+EnvTemplate = namedtuple('EnvTemplate', ['text', 'variables', 'placeholders', 'errors'])
+env_template_cache = {}
+
+
+def ask(app, name, message, default=None, **kwargs):
+    """
+    Returns the answer for a given question. If the answers file contains a
+    value for the app and name, it is used. If an answers file has been loaded
+    and a default value is given, the default is used without asking. Otherwise
+    the user is asked for the value. In non-interactive mode nobody can be
+    asked, so the default is used and a missing answer is recorded for
+    report_missing_answers() and returned as empty string.
+    """
+    section = answers.get(app, {}) if app else answers
+    if name in section:
+        return str(section[name])
+    if (answers or not runtime.interactive) and default is not None:
+        return default
+    if not runtime.interactive:
+        runtime.missing_answers.append(f'{app}.{name}' if app else name)
+        return ''
+    from prompt_toolkit import prompt  # pylint: disable=import-outside-toplevel
+    if default is not None:
+        kwargs['default'] = default
+    return prompt(message, **kwargs)
+
+
+def report_missing_answers():
+    """
+    Reports all answers that were missing in non-interactive mode at once, as
+    keys for the answers file. Returns whether any answer was missing.
+    """
+    if not runtime.missing_answers:
+        return False
+    print_formatted(HTML('<red>Missing answers for non-interactive setup, no files have been changed: {}</red>').format(
+        ', '.join(dict.fromkeys(runtime.missing_answers))))
+    print_formatted('Please add them to the answers file given with "--answers" (see "answers.toml.example").')
+    runtime.missing_answers.clear()
+    return True
+
+
+def create_password(length=25):
+    """
+    Creates a secure password of a given length. The password should contain at
+    least one lower case character, one upper case character and one digit.
+
+    Source: https://docs.python.org/3/library/secrets.html#recipes-and-best-practices
+    """
+    alphabet = string.ascii_letters + string.digits
+    while True:
+        password = ''.join(secrets.choice(alphabet) for i in range(length))
+        if (any(c.islower() for c in password) and
+            any(c.isupper() for c in password) and
+                any(c.isdigit() for c in password)):
+            break
+    return password
+
+
+def generate_htpasswd_bcrypt(username, password):
+    """
+    Generates a htpasswd entry by calculating the bcrypt hash of a given
+    password and append it to the username.
+
+    Sources:
+     - https://www.toor.su/posts/2019/06/htpasswd-with-bcrypt/
+     - https://gist.github.com/zobayer1/d86a59e45ae86198a9efc6f3d8682b49
+    """
+    import bcrypt  # pylint: disable=import-outside-toplevel
+    # generating on command line: printf "admin:$(openssl passwd -apr1 {chosen_password})\n" > traefik_dashboard_auth
+    bcrypted = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=12)).decode('utf-8')
+    return f'{username}:{bcrypted}'
+
+
+def generate_argon_password_hash(password):
+    """
+    Generate a hashed password with argon2 in PHC string format used by Vaultwarden for example.
+
+    Sources:
+     - https://github.com/dani-garcia/vaultwarden/wiki/Enabling-admin-page#secure-the-admin_token 
+     - https://github.com/P-H-C/phc-string-format/blob/master/phc-sf-spec.md
+
+    The gennerated hash should look like this:
+    $argon2id$v=19$m=65540,t=3,p=4$bXBGMENBZUVzT3VUSFErTzQzK25Jck1BN2Z0amFuWjdSdVlIQVZqYzAzYz0$T9m73OdD...
+    """
+    from argon2 import PasswordHasher  # pylint: disable=import-outside-toplevel
+    ph = PasswordHasher(time_cost=3, memory_cost=65540, parallelism=4, hash_len=32, salt_len=32)
+    return ph.hash(password)
+
+
+def collect_secret_files(given_app, keep_existing=False):
+    """
+    Collects the content of all files with secrets referenced in the Docker
+    Compose files for a given app. All necessary input is asked from the user
+    at this point. Returns a map of file paths and their contents. Contents
+    that need an expensive password hash are returned as HashJob, so they can
+    be calculated later together with all other hashes. If existing files
+    should be kept, only missing secret files are created.
+    """
+    secret_files = {}
+    for app, filename in find_all_secrets(given_app):
+        filepath = Path(app) / filename
+        if keep_existing and filepath.is_file() and filepath.stat().st_size > 0:
+            logger.debug('Keeping existing secrets file: %s', filepath)
+            continue
+        if filepath.stem in answers.get(app, {}):
+            # use value from answers file for all kinds of secret files
+            secret_files[filepath] = str(answers[app][filepath.stem])
+        elif 'dashboard_auth' in filename:
+            chosen_password = create_password()
+            print_formatted(f'Generated htpasswd password for Traefik Dashboard (user "admin"): {chosen_password}')
+            print_formatted('Please save this password for later use!')
+            secret_files[filepath] = HashJob(generate_htpasswd_bcrypt, ('admin', chosen_password), '{}')
+        elif 'chronograf_htpasswd_auth' in filename:
+            chosen_password = create_password()
+            print_formatted(f'Generated htpasswd password for Chronograf (user "admin"): {chosen_password}')
+            print_formatted('Please save this password for later use!')
+            secret_files[filepath] = HashJob(generate_htpasswd_bcrypt, ('admin', chosen_password), '{}')
+        elif 'smtp_password' in filename:
+            # handle SMTP password files
+            secret_files[filepath] = ask(app, filepath.stem, 'Please enter the SMTP password: ', is_password=True)
+        elif 'telegram' in filename:
+            # handle telegram URL files
+            bot_id = ask(app, 'telegram_bot_id', 'Please enter the Telegram bot id: ')
+            bot_id = '[bot_id]' if not bot_id else bot_id
+            chat_id = ask(app, 'telegram_chat_id', 'Please enter the Telegram chat id: ')
+            chat_id = '[chat_id]' if not chat_id else chat_id
+            secret_files[filepath] = f'telegram://{bot_id}@telegram/?channels={chat_id}'
+        else:
+            # handle all other files by just filling them with a long password
+            secret_files[filepath] = create_password()
+    return secret_files
+
+
+def write_secret_files(transaction, secret_files):
+    """Writes all given secret files as part of a transaction."""
+    for filepath, content in secret_files.items():
+        transaction.write(filepath, content)
+        logger.debug('Writing secrets file: %s', filepath)
+
+
+def call_timed(function, *args):
+    """Calls a function and returns its result together with the duration of the call."""
+    start_time = time.monotonic()
+    result = function(*args)
+    return result, time.monotonic() - start_time
+
+
+def run_hash_jobs(values):
+    """
+    Calculates the password hashes for all values of type HashJob in the given
+    maps and replaces them by their results. The hashes are calculated in
+    parallel by a pool of processes sized to the number of CPUs, because
+    bcrypt and argon2 are CPU- and memory-bound.
+    """
+    jobs = [(mapping, key) for mapping in values for key, value in mapping.items() if isinstance(value, HashJob)]
+    if not jobs:
+        return
+    print_formatted(f'Calculating {len(jobs)} password hashes...')
+    with timed_step('hash_passwords', jobs=len(jobs)):
+        if len(jobs) == 1:
+            mapping, key = jobs[0]
+            job = mapping[key]
+            result, duration = call_timed(job.function, *job.args)
+            record_event('hash_password', duration=duration, function=job.function.__name__)
+            mapping[key] = job.template.format(result)
+            return
+        with ProcessPoolExecutor(max_workers=min(len(jobs), os.cpu_count() or 1)) as executor:
+            futures = [(mapping, key, executor.submit(call_timed, mapping[key].function, *mapping[key].args))
+                       for mapping, key in jobs]
+            for mapping, key, future in futures:
+                result, duration = future.result()
+                record_event('hash_password', duration=duration, function=mapping[key].function.__name__)
+                mapping[key] = mapping[key].template.format(result)
+
+
+def load_placeholder_index():
+    """
+    Loads the index that records for every configuration file, which
+    placeholders it contained when it was checked for the last time.
+    """
+    try:
+        with open(PLACEHOLDER_INDEX_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_placeholder_index(index):
+    """Writes the index of placeholders in configuration files to disk."""
+    try:
+        write_file_atomically(PLACEHOLDER_INDEX_FILE, json.dumps(index))
+    except OSError as e:
+        logger.debug('Could not save placeholder index: %s', e)
+
+
+def replace_placeholders_in_file(path, replacements):
+    """
+    Replaces all given placeholders in a file in a single streaming pass. The
+    result is written to a temporary file, which replaces the original file
+    only if something has been replaced. Returns the placeholders that have
+    been found.
+    """
+    found = set()
+    fd, temp_name = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+    try:
+        with open(path, 'r', encoding='utf-8') as source, os.fdopen(fd, 'w', encoding='utf-8') as target:
+            for line in source:
+                for placeholder, value in replacements.items():
+                    if placeholder in line:
+                        found.add(placeholder)
+                        line = line.replace(placeholder, value)
+                target.write(line)
+            if found:
+                target.flush()
+                os.fsync(target.fileno())
+        if found:
+            os.chmod(temp_name, path.stat().st_mode & 0o777)
+            os.replace(temp_name, path)
+            fsync_directory(path.parent)
+        else:
+            os.unlink(temp_name)
+    except BaseException:
+        Path(temp_name).unlink(missing_ok=True)
+        raise
+    return found
+
+
+def replace_placeholders_in_files(replacements, pattern='*/*.yml'):
+    """
+    Replaces several placeholders at once in all configuration files matching
+    a given pattern. Files that have not changed since they were found to
+    contain none of the placeholders are skipped by using a persisted index.
+    """
+    index = load_placeholder_index()
+    for path in Path('.').glob(pattern):
+        if not path.is_file():
+            continue
+        stat = path.stat()
+        entry = index.get(str(path))
+        if (entry and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size
+                and not any(entry['found'].get(p, True) for p in replacements)):
+            continue
+        found = replace_placeholders_in_file(path, replacements)
+        if found:
+            logger.debug('Replaced placeholders %s in file: %s', ', '.join(sorted(found)), path)
+        stat = path.stat()
+        checked = entry['found'] if entry and entry['mtime'] == stat.st_mtime else {}
+        # after replacing no checked placeholder is left in the file
+        checked.update({p: False for p in replacements})
+        index[str(path)] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'found': checked}
+    save_placeholder_index(index)
+
+
+def replace_mail_address_in_files(mail_address):
+    """Replaces the example mail address in all configuration files."""
+    replace_placeholders_in_files({EXAMPLE_MAIL_PLACEHOLDER: mail_address})
+
+
+def do_initial_basic_setup():
+    """Initializes basic configuration. Returns whether all answers were given."""
+    from prompt_toolkit.validation import Validator  # pylint: disable=import-outside-toplevel
+    print_formatted(' *** Initializing basic configuration *** ')
+    # input all information from user
+    mail_validator = Validator.from_callable(
+        # do a very simple check for validity (https://stackoverflow.com/a/8022584)
+        lambda text: re.match(r'[^@]+@[^@]+\.[^@]+', text),
+        error_message="Not a valid e-mail address!",
+        move_cursor_to_end=True,
+    )
+    domain_validator = Validator.from_callable(
+        lambda text: re.match(r'\w+\.\w+', text),
+        error_message="Not a valid domain name!",
+        move_cursor_to_end=True,
+    )
+    mail_address = ask(None, 'mail-address', 'Please enter your mail address: ', validator=mail_validator)
+    # get base domain name (for non-ASCII characters in domain names, punycode has to used!)
+    # Source: https://doc.traefik.io/traefik/routing/routers/#host-and-hostregexp
+    domain_prompt = 'Please enter your domain name (third-level domain will be added, e.g. nicedomain.com): '
+    domain_name = ask(None, 'domain-name', domain_prompt, validator=domain_validator)
+    if report_missing_answers():
+        return False
+    # write basic configuration to file
+    write_file_atomically(INITIAL_SETUP_MARKER_FILE,
+                          f'mail-address = "{mail_address}"\ndomain-name = "{domain_name}"\n')
+    logger.debug('Writing basic configuration to file: %s', INITIAL_SETUP_MARKER_FILE)
+    replace_mail_address_in_files(mail_address)
+    # set correct file permissions for acme.json in app 'infrastructure'
+    os.chmod(Path('infrastructure') / 'acme.json', 0o600)
+    return True
+
+
+def compile_env_template(text):
+    """
+    Compiles the content of a .env.template file into its variables and
+    placeholders. Each placeholder gets a kind: domains are derived from
+    SUBDOMAIN_MAP, secrets (passwords and tokens) get a random default value
+    and all other placeholders have to be input by the user. For every
+    variable a pattern is compiled to read the values of its placeholders
+    from an existing .env file. Problems like malformed lines or unknown
+    domain variables are collected instead of raised.
+    """
+    variables, placeholders, errors = [], {}, []
+    for number, line in enumerate(text.split('\n'), start=1):
+        if not line.strip():
+            continue
+        if '=' not in line:
+            if not line.lstrip().startswith('#'):
+                errors.append(f'line {number} is not a variable assignment: {line}')
+            continue
+        name = line.split('=', 1)[0]
+        pattern, names = '', []
+        try:
+            parsed = list(string.Formatter().parse(line))
+        except ValueError as e:
+            errors.append(f'line {number} contains invalid braces: {e}')
+            continue
+        for text_part, placeholder, _, _ in parsed:
+            pattern += re.escape(text_part)
+            if placeholder is None:
+                continue
+            if not re.fullmatch(r'\w+', placeholder):
+                errors.append(f'line {number} contains an invalid placeholder: {{{placeholder}}}')
+                break
+            pattern += f'(?P={placeholder})' if placeholder in names else f'(?P<{placeholder}>.*?)'
+            names.append(placeholder)
+            if placeholder in placeholders:
+                continue
+            if 'DOMAIN' in name:
+                default = SUBDOMAIN_MAP.get(name.lstrip('#').strip())
+                if default is None:
+                    errors.append(f'line {number} contains the unknown domain variable {name} '
+                                  f'(missing in SUBDOMAIN_MAP)')
+                placeholders[placeholder] = EnvPlaceholder(placeholder, 'domain', default)
+            elif 'password' in placeholder or 'token' in placeholder:
+                kind = 'hashed-secret' if placeholder == 'vaultwarden_admin_token' else 'secret'
+                placeholders[placeholder] = EnvPlaceholder(placeholder, kind, None)
+            else:
+                placeholders[placeholder] = EnvPlaceholder(placeholder, 'input', None)
+        else:
+            variables.append(EnvVariable(name, line, tuple(names), re.compile(pattern) if names else None))
+    return EnvTemplate(text, tuple(variables), placeholders, errors)
+
+
+def get_env_template(app):
+    """
+    Returns the compiled .env.template file of an app. The template is only
+    compiled again, when modification time or size of the file have changed.
+    """
+    path = Path(app) / ENV_FILE_TEMPLATE_FILENAME
+    stat = path.stat()
+    cached = env_template_cache.get(app)
+    if cached and cached[0] == (stat.st_mtime, stat.st_size):
+        return cached[1]
+    with open(path, 'r', encoding='utf-8') as f:
+        env_template = compile_env_template(f.read())
+    env_template_cache[app] = ((stat.st_mtime, stat.st_size), env_template)
+    return env_template
+
+
+def check_env_templates(apps):
+    """
+    Compiles the .env.template files of all given apps and reports all
+    problems of all apps at once. Returns the apps whose template is missing
+    or has errors.
+    """
+    failed_apps = []
+    for app in apps:
+        try:
+            errors = get_env_template(app).errors
+        except OSError as e:
+            errors = [str(e)]
+        for error in errors:
+            print_formatted(HTML(' ❌ {} - <red>{}</red>').format(app, error))
+        if errors:
+            failed_apps.append(app)
+    return failed_apps
+
+
+def read_env_lines(app):
+    """Returns all lines of the existing .env file of an app by the names of their variables."""
+    env_file = Path(app) / '.env'
+    if not env_file.is_file():
+        return {}
+    with open(env_file, 'r', encoding='utf-8') as f:
+        return {line.split('=', 1)[0]: line for line in f.read().split('\n') if '=' in line}
+
+
+def read_existing_env_parameters(env_template, existing_lines):
+    """
+    Finds the values of all placeholders from the compiled template in the
+    existing lines of the .env file of an app. Every line of the template
+    containing placeholders is matched against the line of the .env file for
+    the same variable.
+    """
+    parameters = {}
+    for variable in env_template.variables:
+        if variable.pattern is None or variable.name not in existing_lines:
+            continue
+        match = variable.pattern.fullmatch(existing_lines[variable.name])
+        if match:
+            parameters.update(match.groupdict())
+    return parameters
+
+
+def merge_env_template(env_template, existing_lines):
+    """
+    Returns the template for the .env file of an app that has been set up
+    before. Every variable that already exists in the .env file keeps its
+    line as it is, also if it has been changed by hand. Only variables that
+    are new in the template are rendered from it, variables that only exist
+    in the .env file are kept at the end. Also returns the names of the
+    placeholders that are still needed for the new variables.
+    """
+    def escape(line):
+        return line.replace('{', '{{').replace('}', '}}')
+    lines = [escape(existing_lines[line.split('=', 1)[0]]) if '=' in line and line.split('=', 1)[0] in existing_lines
+             else line for line in env_template.text.split('\n')]
+    template_variables = {v.name for v in env_template.variables}
+    additional_lines = [escape(line) for name, line in existing_lines.items() if name not in template_variables]
+    # keep the line break at the end of the file
+    position = len(lines) - 1 if lines[-1] == '' else len(lines)
+    lines[position:position] = additional_lines
+    needed = {name for v in env_template.variables if v.name not in existing_lines for name in v.placeholders}
+    return '\n'.join(lines), needed
+
+
+def collect_env_parameters(app, existing_lines=None):
+    """
+    Collects all parameters for the environment variables from the compiled
+    template (.env.template) and fill in all missing element, like specific
+    domain names, passwords, SMTP parameters, etc. Returns the template and
+    the parameters. Parameters that need an expensive password hash are
+    returned as HashJob. If the existing lines of the .env file are given,
+    they are kept and only parameters for new variables are collected.
+    Values of placeholders found in the existing lines are not asked again.
+    """
+    env_template = get_env_template(app)
+    if env_template.errors:
+        raise ValueError(f'Template of app {app} is invalid: {"; ".join(env_template.errors)}')
+    template, needed = env_template.text, set(env_template.placeholders)
+    existing_parameters = {}
+    if existing_lines:
+        template, needed = merge_env_template(env_template, existing_lines)
+        existing_parameters = read_existing_env_parameters(env_template, existing_lines)
+    parameters = {}
+    domain_name = basic_configuration.get('domain-name', '')
+    for p in env_template.placeholders.values():
+        if p.name not in needed:
+            continue
+        if p.kind == 'domain':
+            # generate domain names from the subdomain, an empty subdomain means the base domain itself
+            parameters[p.name] = f'{p.default}.{domain_name}' if p.default else domain_name
+            continue
+        if p.name in existing_parameters:
+            parameters[p.name] = existing_parameters[p.name]
+            continue
+        cleaned_up_p = p.name.replace('_', ' ')
+        if p.kind in ('secret', 'hashed-secret'):
+            if runtime.interactive and not answers:
+                print_formatted('This seems to be a password or token, so a random secure value is suggested.')
+            parameters[p.name] = ask(app, p.name, f'Please enter parameter "{cleaned_up_p}": ',
+                                     default=create_password())
+        else:
+            parameters[p.name] = ask(app, p.name, f'Please enter parameter "{cleaned_up_p}": ')
+        if p.kind == 'hashed-secret':
+            print_formatted(f'Generating argon2 password hash for password {parameters[p.name]}.')
+            # write hashed password to .env file and put single quotation marks around it
+            parameters[p.name] = HashJob(generate_argon_password_hash, (parameters[p.name],), "'{}'")
+    return template, parameters
+
+
+def write_env_file(transaction, app, template, parameters):
+    """
+    Writes the file with all environment variables for an app and marks the
+    app as initialized as part of a transaction.
+    """
+    filename = Path(app, '.env')
+    print_formatted(f'Writing environment variables to file: {filename}')
+    logger.debug('Writing env vars to file: %s', filename)
+    transaction.write(filename, template.format(**parameters))
+    # mark single app directories as initialized
+    marker_file = Path(app) / INITIAL_SETUP_MARKER_FILE
+    if not marker_file.exists():
+        transaction.write(marker_file, '')
+
+
+def hash_content(content):
+    """Returns the SHA-256 hash of a given string or bytes."""
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+
+def create_setup_manifest(app):
+    """
+    Creates the manifest describing the current setup of an app: the hash of
+    the .env.template file, the list of secret files from the Docker Compose
+    file and the hashes of all produced files.
+    """
+    template_file = Path(app) / ENV_FILE_TEMPLATE_FILENAME
+    secret_files = sorted(filename for _, filename in find_all_secrets(app))
+    produced_files = {}
+    for filename in secret_files + ['.env']:
+        path = Path(app) / filename
+        produced_files[filename] = hash_content(path.read_bytes()) if path.is_file() else None
+    return {'template': hash_content(template_file.read_bytes()) if template_file.is_file() else None,
+            'secrets': secret_files, 'files': produced_files}
+
+
+def is_setup_up_to_date(app):
+    """
+    Checks whether the setup of an app is up to date, meaning template and
+    secrets have not changed and all produced files still exist unchanged
+    since the last setup.
+    """
+    manifest_file = Path(app) / SETUP_MANIFEST_FILENAME
+    if not check_if_initial_setup_completed(app) or not manifest_file.is_file():
+        return False
+    try:
+        with open(manifest_file, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return manifest == create_setup_manifest(app)
+
+
+def do_initial_setup_for_apps(apps, force=False):
+    """
+    Initializes all environment variables from a template file (.env.template)
+    and fill all missing element, like specific domain names, passwords, SMTP
+    parameters, etc. Also all necessary secret files will be created and filled
+    with a random and secure password.
+
+    Apps that have been set up before are only updated incrementally: existing
+    secret files and values in the .env file are kept and only new secrets and
+    placeholders are added. Apps whose setup manifest shows no changes are
+    skipped entirely. If forced, all files are generated from scratch.
+
+    All input is asked from the user for all given apps first. In
+    non-interactive mode all missing answers are reported at once and no file
+    is written. Afterwards all password hashes are calculated in one parallel
+    batch and all files are written. The files of each app are written in a
+    single transaction, so that a failing app leaves none of its files
+    half-written. Returns whether all apps have been set up successfully.
+    """
+    # report problems in the templates of all apps before asking for any input
+    invalid_apps = check_env_templates(apps)
+    setups = {}
+    for app in [app for app in apps if app not in invalid_apps]:
+        if not force and is_setup_up_to_date(app):
+            print_formatted(f' *** App configuration for {app} is up to date *** ')
+            continue
+        print_formatted(f' *** Initializing app configuration for {app} *** ')
+        incremental = not force and check_if_initial_setup_completed(app)
+        secret_files = collect_secret_files(app, keep_existing=incremental)
+        template, parameters = collect_env_parameters(app, read_env_lines(app) if incremental else None)
+        setups[app] = (secret_files, template, parameters)
+    if report_missing_answers():
+        return False
+    run_hash_jobs([mapping for secret_files, _, parameters in setups.values()
+                   for mapping in (secret_files, parameters)])
+    success = not invalid_apps
+    for app, (secret_files, template, parameters) in setups.items():
+        start_time = time.monotonic()
+        try:
+            with FileTransaction() as transaction:
+                write_secret_files(transaction, secret_files)
+                write_env_file(transaction, app, template, parameters)
+            write_file_atomically(Path(app) / SETUP_MANIFEST_FILENAME, json.dumps(create_setup_manifest(app)))
+        except (OSError, KeyError, ValueError) as e:
+            logger.debug('Setup of app %s failed: %s', app, e)
+            print_formatted(HTML('<red>Setup of app {} failed, no files have been changed: {}</red>').format(
+                app, repr(e)))
+            record_event('setup', app, time.monotonic() - start_time, False, force=force)
+            success = False
+            continue
+        record_event('setup', app, time.monotonic() - start_time, force=force)
+    return success
+
+
+def do_initial_setup_for_app(given_app):
+    """Initializes configuration and secret files for a single app."""
+    return do_initial_setup_for_apps([given_app])
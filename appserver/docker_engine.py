@@ -0,0 +1,449 @@
+"""
+Queries the state of containers from Docker, either with the docker CLI or
+directly from the Docker Engine API, and keeps it up to date from the Docker
+events in the interactive interface.
+"""
+
+import re
+import os
+import json
+import time
+import socket
+import threading
+from pathlib import Path
+from urllib.parse import urlencode
+from datetime import datetime, timezone
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from .common import app_name_map, basic_configuration, logger, runtime
+from .compose_files import get_compose_index
+
+
+DOCKER_SOCKET = '/var/run/docker.sock'
+DOCKER_BACKENDS = ('cli', 'api')
+
+ContainerInfo = namedtuple('ContainerInfo', ['name', 'service', 'state', 'health', 'restart_count',
+                                             'started_at', 'image', 'image_id', 'config_hash'])
+
+
+class DockerClientRegistry(dict):
+    """
+    Maps all apps to instances of DockerClient. Each client is created on
+    first access and reused afterwards. Before creating a client the Docker
+    Compose file and the .env file of the app are checked to exist.
+
+    (Python-on-Whales: https://gabrieldemarmiesse.github.io/python-on-whales/sub-commands/compose/)
+    """
+
+    def __missing__(self, app):
+        from python_on_whales import DockerClient  # pylint: disable=import-outside-toplevel
+        if app not in app_name_map:
+            raise KeyError(app)
+        compose_file = Path(app) / 'docker-compose.yml'
+        env_file = Path(app) / '.env'
+        for filename in (compose_file, env_file):
+            if not filename.is_file():
+                raise FileNotFoundError(f'File {filename} is missing. Please run "setup {app}" first!')
+        logger.debug('Creating Docker client for app: %s', app)
+        docker = DockerClient(compose_files=[compose_file], compose_env_file=env_file)
+        self[app] = docker
+        return docker
+
+
+class DockerEngineError(Exception):
+    """Error while querying the Docker Engine API."""
+
+
+class DockerEngineClient:
+    """
+    Client for read-only queries (containers, images, stats and events) that
+    talks to the Docker Engine API over its Unix socket directly instead of
+    starting a docker CLI process for every call. Connections are kept alive
+    and reused from a pool, so that concurrent threads can query Docker at
+    the same time without connecting again.
+
+    (Docker Engine API: https://docs.docker.com/engine/api/latest/)
+    """
+    MAX_CONNECTIONS = 8
+
+    def __init__(self, socket_path=DOCKER_SOCKET, timeout=30):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.idle_connections = []
+        self.lock = threading.Lock()
+
+    def _create_connection(self, timeout):
+        """Creates a HTTP connection that is (re)connected via the Unix socket."""
+        import http.client  # pylint: disable=import-outside-toplevel
+        connection = http.client.HTTPConnection('localhost', timeout=timeout)
+
+        def connect():
+            connection.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.sock.settimeout(timeout)
+            connection.sock.connect(self.socket_path)
+        connection.connect = connect
+        return connection
+
+    def request(self, path, **params):
+        """
+        Sends a GET request to the Docker Engine API and returns the decoded
+        JSON response. A connection that has been closed by Docker in the
+        meantime is replaced once.
+        """
+        import http.client  # pylint: disable=import-outside-toplevel
+        url = f'{path}?{urlencode(params)}' if params else path
+        for attempt in range(2):
+            with self.lock:
+                connection = self.idle_connections.pop() if self.idle_connections else None
+            if connection is None:
+                connection = self._create_connection(self.timeout)
+            try:
+                connection.request('GET', url)
+                response = connection.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                if attempt == 0:
+                    continue
+                raise DockerEngineError(f'Could not query Docker Engine API at {self.socket_path}: {e}') from e
+            with self.lock:
+                self.idle_connections.append(connection)
+            if response.status >= 400:
+                message = json.loads(body).get('message', '') if body.startswith(b'{') else body.decode()
+                raise DockerEngineError(f'Docker Engine API returned {response.status} for {path}: {message}')
+            return json.loads(body) if body else None
+        return None
+
+    def list_containers(self, label):
+        """
+        Returns a summary (state, health as part of the status, labels and
+        image) of all containers with the given label from a single request.
+        """
+        return self.request('/containers/json', all=1, filters=json.dumps({'label': [label]}))
+
+    def inspect_containers(self, container_ids):
+        """
+        Returns the detailed information of all given containers. The API can
+        only inspect a single container per request, so the containers are
+        inspected concurrently over several connections.
+        """
+        if len(container_ids) <= 1:
+            return [self.request(f'/containers/{container_id}/json') for container_id in container_ids]
+        with ThreadPoolExecutor(max_workers=min(len(container_ids), self.MAX_CONNECTIONS)) as executor:
+            return list(executor.map(lambda container_id: self.request(f'/containers/{container_id}/json'),
+                                     container_ids))
+
+    def list_images(self):
+        """Returns a summary for all images."""
+        return self.request('/images/json')
+
+    def inspect_image(self, image):
+        """Returns the detailed information of an image given by its reference or id."""
+        return self.request(f'/images/{image}/json')
+
+    def container_stats(self, container):
+        """Returns a single snapshot of the resource usage of a container."""
+        return self.request(f'/containers/{container}/stats', stream=0)
+
+    def events(self, since=None, **filters):
+        """
+        Yields all events matching the given filters as they occur, starting
+        with the events since a given time. The stream uses its own
+        connection, because it is kept open without a timeout.
+        """
+        import http.client  # pylint: disable=import-outside-toplevel
+        params = {'filters': json.dumps(filters)}
+        if since:
+            params['since'] = int(since.timestamp())
+        connection = self._create_connection(None)
+        try:
+            connection.request('GET', f'/events?{urlencode(params)}')
+            response = connection.getresponse()
+            if response.status >= 400:
+                raise DockerEngineError(f'Docker Engine API returned {response.status} for /events')
+            for line in response:
+                if line.strip():
+                    yield json.loads(line)
+        except (OSError, http.client.HTTPException) as e:
+            raise DockerEngineError(f'Could not watch events of Docker Engine API: {e}') from e
+        finally:
+            connection.close()
+
+
+def get_docker_backend():
+    """Returns the backend for read-only queries, either the docker CLI ("cli") or the Engine API ("api")."""
+    backend = runtime.docker_backend or basic_configuration.get('docker-backend', 'cli')
+    if backend not in DOCKER_BACKENDS:
+        logger.debug('Unknown Docker backend %s, using docker CLI.', backend)
+        return 'cli'
+    return backend
+
+
+def get_docker_reader(docker_client=None):
+    """
+    Returns the client for read-only queries like listing containers or
+    images. With the backend "api" a single client for the Docker Engine API
+    is shared by all threads, otherwise the given or a new DockerClient is
+    used. The socket of the Engine API is taken from DOCKER_HOST, if it is set
+    to a Unix socket.
+    """
+    if get_docker_backend() == 'api':
+        if runtime.engine_client is None:
+            docker_host = os.environ.get('DOCKER_HOST', '')
+            socket_path = docker_host[len('unix://'):] if docker_host.startswith('unix://') else DOCKER_SOCKET
+            runtime.engine_client = DockerEngineClient(socket_path)
+        return runtime.engine_client
+    if docker_client is None:
+        from python_on_whales import DockerClient  # pylint: disable=import-outside-toplevel
+        docker_client = DockerClient()
+    return docker_client
+
+
+def get_docker_errors():
+    """
+    Returns the exceptions raised by both backends when a call to Docker fails
+    or the docker CLI could not be found.
+    """
+    from python_on_whales import ClientNotFoundError  # pylint: disable=import-outside-toplevel
+    from python_on_whales.exceptions import DockerException  # pylint: disable=import-outside-toplevel
+    return (DockerException, ClientNotFoundError, DockerEngineError)
+
+
+def parse_docker_time(value):
+    """
+    Parses a timestamp from the Docker Engine API (RFC 3339 with nanoseconds).
+    Returns None for unset timestamps.
+    """
+    match = re.match(r'^([^.Z+]+)(\.\d+)?(Z|[+-]\d\d:\d\d)$', value or '')
+    if not match or value.startswith('0001-'):
+        return None
+    base, fraction, zone = match.groups()
+    # trailing zeros are dropped (RFC3339Nano), but fromisoformat() before Python 3.11 needs 6 digits
+    fraction = fraction[:7].ljust(7, '0') if fraction else ''
+    return datetime.fromisoformat(base + fraction + ('+00:00' if zone == 'Z' else zone))
+
+
+def get_project_name(app):
+    """Returns the name of the Docker Compose project for a given app like Docker Compose derives it."""
+    entry = get_compose_index().get(app)
+    if entry and entry['name']:
+        return entry['name']
+    return re.sub(r'[^a-z0-9_-]', '', app.lower())
+
+
+def inspect_containers(docker_client, container_ids):
+    """
+    Returns the detailed information of all given containers from a single
+    call of "docker container inspect". The container objects of
+    python_on_whales would instead be inspected by a call of their own, when
+    one of their attributes is read for the first time.
+    """
+    from python_on_whales.utils import run  # pylint: disable=import-outside-toplevel
+    if not container_ids:
+        return []
+    return json.loads(run(docker_client.docker_cmd + ['container', 'inspect', *container_ids]))
+
+
+def parse_container_details(c):
+    """
+    Returns the labels and the information about a container from its
+    detailed information as returned by "docker container inspect".
+    """
+    labels = c['Config'].get('Labels') or {}
+    health = c['State'].get('Health')
+    return labels, ContainerInfo(
+        name=c['Name'].lstrip('/'), service=labels.get('com.docker.compose.service', ''),
+        state=c['State']['Status'], health=health['Status'] if health else None,
+        restart_count=c['RestartCount'], started_at=parse_docker_time(c['State'].get('StartedAt')),
+        image=c['Config']['Image'], image_id=c['Image'], config_hash=labels.get('com.docker.compose.config-hash'))
+
+
+def parse_container_summary(c):
+    """
+    Returns the labels and the information about a container from its
+    summary as listed by the Docker Engine API. The summary contains the
+    health only as part of the status text like "Up 2 hours (healthy)" and
+    neither the restart count nor the start time.
+    """
+    labels = c.get('Labels') or {}
+    health = re.search(r'\((?:health: )?(starting|healthy|unhealthy)\)', c.get('Status') or '')
+    return labels, ContainerInfo(
+        name=c['Names'][0].lstrip('/'), service=labels.get('com.docker.compose.service', ''),
+        state=c['State'], health=health.group(1) if health else None, restart_count=None, started_at=None,
+        image=c['Image'], image_id=c['ImageID'], config_hash=labels.get('com.docker.compose.config-hash'))
+
+
+def query_all_containers(docker_client, project=None, details=False):
+    """
+    Queries all containers of all Docker Compose projects at once and groups
+    them by app, instead of calling "docker compose ps" for every single
+    stack. If a project name is given, only the containers of this project
+    are queried.
+
+    With the docker CLI a single list and a single inspect call are
+    necessary. The Docker Engine API lists state, health, labels and image of
+    all containers with a single request, but restart count and start time
+    are only part of the detailed information, which the API returns for a
+    single container per request. Therefore the containers are only
+    inspected, if these details are requested for the status output.
+    """
+    project_map = {get_project_name(app): app for app in app_name_map}
+    containers = {app: [] for app in app_name_map}
+    label = f'com.docker.compose.project={project}' if project else 'com.docker.compose.project'
+    if isinstance(docker_client, DockerEngineClient):
+        summaries = docker_client.list_containers(label)
+        if details:
+            parsed = map(parse_container_details, docker_client.inspect_containers([c['Id'] for c in summaries]))
+        else:
+            parsed = map(parse_container_summary, summaries)
+    else:
+        # only the ids are read from the listed containers, which does not inspect them
+        container_ids = [c.id for c in docker_client.container.list(all=True, filters={'label': label})]
+        parsed = map(parse_container_details, inspect_containers(docker_client, container_ids))
+    for labels, container in parsed:
+        app = project_map.get(labels.get('com.docker.compose.project'))
+        if app is not None:
+            containers[app].append(container)
+    return containers
+
+
+class ContainerStatusCache:
+    """
+    Keeps an in-memory model of the state of all containers per stack. The
+    model is populated once and afterwards updated by watching the Docker
+    events stream in background threads, so that reading the state of the
+    stacks does not need any call to Docker. While watching the events fails,
+    the model is dropped, so that readers query Docker themselves.
+    """
+    RETRY_INTERVAL = 10
+    MAX_RETRY_INTERVAL = 300
+    DEBOUNCE_INTERVAL = 0.5
+
+    def __init__(self, docker_client):
+        self.docker_client = docker_client
+        self.containers = None
+        self.lock = threading.Lock()
+        self.pending_projects = set()
+        self.pending_event = threading.Event()
+
+    def start(self):
+        """Starts the background threads for watching events and refreshing the model."""
+        threading.Thread(target=self._watch_events, name='docker-events', daemon=True).start()
+        threading.Thread(target=self._refresh_pending, name='status-refresh', daemon=True).start()
+
+    def is_populated(self):
+        """Checks whether the model has been populated already."""
+        return self.containers is not None
+
+    def invalidate(self):
+        """Drops the model until it is populated again, because it may be outdated."""
+        with self.lock:
+            self.containers = None
+
+    def get_containers(self):
+        """Returns a copy of the container information for all stacks."""
+        with self.lock:
+            return dict(self.containers) if self.containers is not None else None
+
+    def get_running_stacks(self):
+        """Returns all stacks that have at least one running container."""
+        with self.lock:
+            return [app for app, containers in (self.containers or {}).items()
+                    if any(c.state == 'running' for c in containers)]
+
+    def count_healthy_stacks(self):
+        """
+        Counts the stacks with existing containers and how many of them are
+        healthy, meaning all containers are running and none is unhealthy.
+        """
+        with self.lock:
+            stacks = [containers for containers in (self.containers or {}).values() if containers]
+        healthy = [containers for containers in stacks
+                   if all(c.state == 'running' and c.health != 'unhealthy' for c in containers)]
+        return len(healthy), len(stacks)
+
+    def refresh(self, project=None):
+        """
+        Queries the containers of all stacks or only of a given project from
+        Docker. A single project is only updated, if the model is populated.
+        """
+        containers = query_all_containers(self.docker_client, project, details=True)
+        with self.lock:
+            if project is None:
+                self.containers = containers
+            elif self.containers is not None:
+                app = {get_project_name(app): app for app in app_name_map}.get(project)
+                if app:
+                    self.containers[app] = containers[app]
+
+    def _watch_events(self):
+        """
+        Subscribes to all container events, populates the model and marks
+        projects as changed for every event. The subscription starts at the
+        time before the model is populated, so that no change in between is
+        lost. If watching fails for any reason, the model is dropped and
+        watching is started again after an increasing delay.
+        """
+        failures = 0
+        while True:
+            start_time = time.monotonic()
+            try:
+                events = self._read_events(since=datetime.now(timezone.utc))
+                self.refresh()
+                for attributes in events:
+                    project = attributes.get('com.docker.compose.project')
+                    if project:
+                        with self.lock:
+                            self.pending_projects.add(project)
+                        self.pending_event.set()
+            except get_docker_errors() as e:
+                logger.debug('Watching Docker events failed: %s', e)
+            except Exception:  # pylint: disable=broad-exception-caught
+                # keep the thread alive, otherwise the model would never be updated again
+                logger.exception('Unexpected error while watching Docker events')
+            self.invalidate()
+            # only failures in quick succession increase the delay
+            failures = 1 if time.monotonic() - start_time > self.MAX_RETRY_INTERVAL else failures + 1
+            time.sleep(self._get_retry_delay(failures))
+
+    def _read_events(self, since):
+        """Yields the attributes of the actor of every container event since a given time from the used backend."""
+        if isinstance(self.docker_client, DockerEngineClient):
+            for event in self.docker_client.events(since=since, type=['container']):
+                yield (event.get('Actor') or {}).get('Attributes') or {}
+        else:
+            for event in self.docker_client.system.events(since=since, filters={'type': 'container'}):
+                yield event.actor.attributes if event.actor else {}
+
+    def _refresh_pending(self):
+        """
+        Refreshes all projects that have been changed, bundling bursts of
+        events. A dropped model is populated again completely. If refreshing
+        fails for any reason, the model is dropped and refreshing is retried
+        after an increasing delay.
+        """
+        failures = 0
+        while True:
+            self.pending_event.wait()
+            time.sleep(self._get_retry_delay(failures) if failures else self.DEBOUNCE_INTERVAL)
+            self.pending_event.clear()
+            with self.lock:
+                projects, self.pending_projects = self.pending_projects, set()
+            try:
+                for project in projects if self.is_populated() else [None]:
+                    self.refresh(project)
+                failures = 0
+                continue
+            except get_docker_errors() as e:
+                logger.debug('Could not refresh status of projects %s: %s', ', '.join(map(str, projects)), e)
+            except Exception:  # pylint: disable=broad-exception-caught
+                # keep the thread alive, otherwise the model would never be updated again
+                logger.exception('Unexpected error while refreshing status of projects')
+            self.invalidate()
+            failures += 1
+            self.pending_event.set()
+
+    def _get_retry_delay(self, failures):
+        """Returns the delay before retrying after the given number of failures in a row."""
+        return min(self.RETRY_INTERVAL * 2 ** (failures - 1), self.MAX_RETRY_INTERVAL)
@@ -0,0 +1,397 @@
+"""
+Starts, stops, restarts, pulls and updates Docker stacks with Docker Compose,
+for multiple stacks concurrently.
+"""
+
+import re
+import sys
+import time
+from pathlib import Path
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .common import (HTML, STARTUP_ORDER, check_if_initial_setup_completed, get_max_workers, get_short_error_message,
+                     logger, print_formatted, record_event, recorded_operation, timed_step)
+from .compose_files import find_all_images, find_service_images
+from .configuration import do_initial_setup_for_app, do_initial_setup_for_apps
+from .docker_engine import (DockerEngineClient, get_docker_errors, get_docker_reader, get_project_name,
+                            query_all_containers)
+from .planning import select_apps_to_start
+
+
+HEALTHCHECK_TIMEOUT = 300
+HEALTHCHECK_INTERVAL = 2
+
+
+@recorded_operation('start')
+def start_app(docker_clients, app, force=False, ignore_memory=False):
+    """
+    Starts all containers of a specific Docker stack. If the stack is already
+    running with its current configuration, nothing is done unless forced.
+    If the stack does not fit into the available memory, it is not started
+    unless the memory check is ignored.
+    """
+    print_formatted(f' *** Starting app {app} *** \n')
+    if not check_if_initial_setup_completed(app) and not do_initial_setup_for_app(app):
+        return False
+    pending_apps, admitted_apps = select_apps_to_start([app], force, ignore_memory)
+    if not admitted_apps:
+        return not pending_apps
+    return run_compose_for_app(docker_clients, app, compose_up)
+
+
+def compose_up(docker_client):
+    """Starts all containers of a Docker stack."""
+    docker_client.compose.up(services=None, build=False, detach=True, pull='missing')
+
+
+def compose_down(docker_client):
+    """Stops and removes all containers of a Docker stack."""
+    docker_client.compose.down()
+
+
+def compose_restart(docker_client):
+    """Restarts all containers of a Docker stack."""
+    docker_client.compose.restart()
+
+
+def compose_pull(docker_client):
+    """Pulls the images of all containers of a Docker stack."""
+    docker_client.compose.pull()
+
+
+def compose_up_service(docker_client, service, pull):
+    """
+    Creates or recreates a single service of a Docker stack without touching
+    the services it depends on. compose.up() of python-on-whales only
+    supports "--no-deps" from version 0.81 on, so Docker Compose is called
+    directly.
+    """
+    from python_on_whales.utils import run  # pylint: disable=import-outside-toplevel
+    run(docker_client.docker_compose_cmd + ['up', '--detach', '--no-deps', '--pull', pull, service])
+
+
+# names of the actions for multiple stacks as recorded in events and as shown in the output
+ACTION_NAMES = {compose_up: ('start', 'Starting'), compose_down: ('stop', 'Stopping'),
+                compose_restart: ('restart', 'Restarting')}
+
+
+def run_compose_for_app(docker_clients, app, action):
+    """
+    Executes an action like compose_up() for a single Docker stack as timed
+    step. If the action fails, the error is shown and False is returned.
+    """
+    try:
+        docker_client = docker_clients[app]
+        with timed_step(action.__name__, app):
+            action(docker_client)
+    except FileNotFoundError as e:
+        print_formatted(HTML('<red>{}</red>').format(e))
+        return False
+    except get_docker_errors() as e:
+        logger.debug('Could not execute %s for app %s: %s', action.__name__, app, e)
+        print_formatted(HTML(' ❌ {} - <red>{}</red>').format(app, get_short_error_message(e)))
+        return False
+    return True
+
+
+def run_compose_timed(docker_clients, app, action):
+    """
+    Executes an action like compose_up() for a specific Docker stack and
+    measures the time it takes. Returns the duration in seconds and an error
+    message, if the action failed.
+    """
+    operation, _ = ACTION_NAMES.get(action, (action.__name__, None))
+    start_time = time.monotonic()
+    try:
+        action(docker_clients[app])
+        error = None
+    except FileNotFoundError as e:
+        error = str(e)
+    except get_docker_errors() as e:
+        logger.debug('Could not execute %s for app %s: %s', action.__name__, app, e)
+        error = get_short_error_message(e)
+    duration = time.monotonic() - start_time
+    record_event(operation, app, duration, error is None)
+    return duration, error
+
+
+def output_timing_report(title, results):
+    """Outputs the duration and errors for each stack that has been handled."""
+    print_formatted(f'\n *** {title} *** \n')
+    for app, (duration, error) in results.items():
+        mark = '❌' if error else '✔️'
+        print_formatted(f' {mark} {app:<20} {duration:6.1f} s')
+        if error:
+            print_formatted(HTML('    - <red>{}</red>').format(error))
+    failed = [app for app, (_, error) in results.items() if error]
+    if failed:
+        print_formatted(HTML(f'\n<red>{len(failed)} of {len(results)} stacks failed: {", ".join(failed)}</red>'))
+
+
+def run_for_apps(docker_clients, apps, action, *, ordered_first=(), ordered_last=()):
+    """
+    Executes an action for multiple Docker stacks. The stacks given as
+    ordered_first are handled before and the stacks given as ordered_last
+    after all other stacks, one after another in the given order. All other
+    stacks are handled concurrently with a limited number of workers. A
+    failing stack does not abort the other stacks. Afterwards a report with
+    the duration and errors of each stack is shown.
+    """
+    _, verb = ACTION_NAMES[action]
+    results = {}
+    for app in [app for app in ordered_first if app in apps]:
+        print_formatted(f' *** {verb} app {app} *** ')
+        results[app] = run_compose_timed(docker_clients, app, action)
+    concurrent_apps = [app for app in apps if app not in ordered_first and app not in ordered_last]
+    with ThreadPoolExecutor(max_workers=get_max_workers()) as executor:
+        futures = {}
+        for app in concurrent_apps:
+            print_formatted(f' *** {verb} app {app} *** ')
+            futures[executor.submit(run_compose_timed, docker_clients, app, action)] = app
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    for app in [app for app in ordered_last if app in apps]:
+        print_formatted(f' *** {verb} app {app} *** ')
+        results[app] = run_compose_timed(docker_clients, app, action)
+    results = {app: results[app] for app in apps}
+    output_timing_report(f'{verb} report', results)
+    return not any(error for _, error in results.values())
+
+
+def start_apps(docker_clients, apps, force=False, ignore_memory=False):
+    """
+    Starts multiple Docker stacks. The stacks from STARTUP_ORDER are started
+    first and one after another, because all other stacks depend on them. The
+    remaining stacks are started concurrently with a limited number of workers.
+    Stacks that are already running with their current configuration are
+    skipped unless forced and stacks that do not fit into the available
+    memory are refused unless the memory check is ignored.
+    """
+    # initial setup may ask for user input, so it has to be done before starting anything
+    uninitialized_apps = [app for app in apps if not check_if_initial_setup_completed(app)]
+    if uninitialized_apps:
+        do_initial_setup_for_apps(uninitialized_apps)
+    pending_apps, admitted_apps = select_apps_to_start(apps, force, ignore_memory)
+    if not admitted_apps:
+        return not pending_apps
+    success = run_for_apps(docker_clients, admitted_apps, compose_up, ordered_first=STARTUP_ORDER)
+    return success and len(admitted_apps) == len(pending_apps)
+
+
+def stop_apps(docker_clients, apps):
+    """
+    Stops multiple Docker stacks concurrently. The stacks from STARTUP_ORDER
+    are stopped last and in reverse order, because all other stacks depend on
+    them.
+    """
+    apps = [app for app in apps if check_if_initial_setup_completed(app)]
+    return run_for_apps(docker_clients, apps, compose_down, ordered_last=STARTUP_ORDER[::-1])
+
+
+def restart_apps(docker_clients, apps):
+    """
+    Restarts multiple Docker stacks. The stacks from STARTUP_ORDER are
+    restarted first, all other stacks concurrently afterwards.
+    """
+    apps = [app for app in apps if check_if_initial_setup_completed(app)]
+    return run_for_apps(docker_clients, apps, compose_restart, ordered_first=STARTUP_ORDER)
+
+
+@recorded_operation('stop')
+def stop_app(docker_clients, app):
+    """Stops all containers of a specific Docker stack."""
+    if check_if_initial_setup_completed(app):
+        print_formatted(f' *** Stopping app {app} *** \n')
+        return run_compose_for_app(docker_clients, app, compose_down)
+    return True
+
+
+@recorded_operation('restart')
+def restart_app(docker_clients, app):
+    """Restarts all containers of a specific Docker stack."""
+    if check_if_initial_setup_completed(app):
+        print_formatted(f' *** Restarting app {app} *** \n')
+        return run_compose_for_app(docker_clients, app, compose_restart)
+    return True
+
+
+@recorded_operation('pull')
+def pull_app(docker_clients, app):
+    """Pulls all containers of a specific Docker stack."""
+    print_formatted(f' *** Pulling app {app} *** \n')
+    if check_if_initial_setup_completed(app):
+        return run_compose_for_app(docker_clients, app, compose_pull)
+    return True
+
+
+def pull_image(docker_client, image, counter=None):
+    """
+    Pulls a single image and returns an error message, if the image could not
+    be pulled. The output of the docker CLI is read line by line, so that a
+    given counter of a progress bar shows how many layers of the image have
+    been pulled already.
+    """
+    from python_on_whales.utils import stream_stdout_and_stderr  # pylint: disable=import-outside-toplevel
+    start_time = time.monotonic()
+    layers, completed_layers = set(), set()
+    try:
+        for _, line in stream_stdout_and_stderr(docker_client.docker_cmd + ['image', 'pull', image]):
+            match = re.match(r'([0-9a-f]{12}): (.+)', line.decode('utf-8', 'replace').strip())
+            if not match or counter is None:
+                continue
+            layer, layer_status = match.groups()
+            layers.add(layer)
+            if layer_status in ('Pull complete', 'Already exists'):
+                completed_layers.add(layer)
+            counter.total = len(layers)
+            counter.items_completed = len(completed_layers)
+    except get_docker_errors() as e:
+        logger.debug('Could not pull image %s: %s', image, e)
+        record_event('pull_image', duration=time.monotonic() - start_time, success=False, image=image)
+        return get_short_error_message(e)
+    record_event('pull_image', duration=time.monotonic() - start_time, image=image)
+    return None
+
+
+def pull_apps(docker_clients, apps, interactive=False):
+    """
+    Pulls all images of the given Docker stacks. Images used by more than one
+    stack are pulled only once and all images are pulled concurrently with a
+    limited number of workers. In the interactive interface on a terminal the
+    progress of the layers of each image is shown while pulling, otherwise
+    every pulled image is reported on a line of its own.
+    """
+    apps = [app for app in apps if check_if_initial_setup_completed(app) and (Path(app) / '.env').is_file()]
+    all_images = find_all_images(apps)
+    print_formatted(f' *** Pulling {len(all_images)} images for {len(apps)} apps *** \n')
+    errors = {}
+    progress_bar = nullcontext()
+    if interactive and sys.stdin.isatty():
+        from prompt_toolkit.shortcuts import ProgressBar  # pylint: disable=import-outside-toplevel
+        progress_bar = ProgressBar(title='Pulling images')
+    with progress_bar as pb:
+        with ThreadPoolExecutor(max_workers=get_max_workers()) as executor:
+            futures = {}
+            for image, image_apps in all_images.items():
+                counter = pb(label=image) if pb else None
+                future = executor.submit(pull_image, docker_clients[image_apps[0]], image, counter)
+                futures[future] = (image, counter)
+            for future in as_completed(futures):
+                image, counter = futures[future]
+                error = future.result()
+                if error:
+                    errors[image] = error
+                if counter and error:
+                    counter.stopped = True
+                elif counter:
+                    # images without layers to pull do not show any progress until they are done
+                    counter.total = counter.total or 1
+                    counter.items_completed = counter.total
+                    counter.done = True
+                elif not error:
+                    logger.info('Pulled image %s', image)
+                    print_formatted(f' ✔️ {image} ({", ".join(all_images[image])})')
+    for image, error in errors.items():
+        print_formatted(HTML(' ❌ {} ({}) - <red>{}</red>').format(image, ', '.join(all_images[image]), error))
+    return not errors
+
+
+def find_outdated_services(docker_client, app):
+    """
+    Finds all services of an app whose running container uses another image
+    than the one currently available locally for the image reference of the
+    service, e.g. because a newer image has been pulled.
+    """
+    reader = get_docker_reader(docker_client)
+    containers = query_all_containers(reader, get_project_name(app))[app]
+    outdated_services = []
+    for service, image in find_service_images(app).items():
+        service_containers = [c for c in containers if c.service == service]
+        if not service_containers:
+            continue
+        try:
+            if isinstance(reader, DockerEngineClient):
+                local_image_id = reader.inspect_image(image)['Id']
+            else:
+                local_image_id = reader.image.inspect(image).id
+        except get_docker_errors() as e:
+            logger.debug('Could not inspect image %s: %s', image, e)
+            continue
+        if any(c.image_id != local_image_id for c in service_containers):
+            outdated_services.append(service)
+    return outdated_services
+
+
+def wait_for_healthy(docker_client, app, service, timeout=HEALTHCHECK_TIMEOUT):
+    """
+    Waits until all containers of a service are running and, if they define a
+    healthcheck, are healthy. Returns an error message if the service did not
+    become healthy within the given time.
+    """
+    reader = get_docker_reader(docker_client)
+    deadline = time.monotonic() + timeout
+    while True:
+        containers = [c for c in query_all_containers(reader, get_project_name(app))[app]
+                      if c.service == service]
+        if containers and all(c.state == 'running' and c.health in (None, 'healthy') for c in containers):
+            return None
+        if any(c.state in ('exited', 'dead') or c.health == 'unhealthy' for c in containers):
+            return f'service {service} is not running or unhealthy'
+        if time.monotonic() > deadline:
+            return f'service {service} did not become healthy within {timeout} s'
+        time.sleep(HEALTHCHECK_INTERVAL)
+
+
+@recorded_operation('update')
+def update_app(docker_clients, app):
+    """
+    Recreates all services of a specific Docker stack whose image has changed.
+    The services are recreated one after another and every service has to
+    become healthy before the next one is recreated. All other services keep
+    running. If a service does not become healthy, the update of the stack is
+    aborted.
+    """
+    docker_client = docker_clients[app]
+    outdated_services = find_outdated_services(docker_client, app)
+    if not outdated_services:
+        print_formatted(f' ✔️ {app} - all services are up to date')
+        return True
+    for service in outdated_services:
+        print_formatted(f' *** Updating service {service} of app {app} *** ')
+        start_time = time.monotonic()
+        try:
+            compose_up_service(docker_client, service, pull='never')
+        except get_docker_errors() as e:
+            logger.debug('Could not recreate service %s of app %s: %s', service, app, e)
+            print_formatted(HTML(' ❌ {}/{} - <red>{}</red>').format(app, service, get_short_error_message(e)))
+            record_event('update_service', app, time.monotonic() - start_time, False, service=service)
+            return False
+        error = wait_for_healthy(docker_client, app, service)
+        record_event('update_service', app, time.monotonic() - start_time, error is None, service=service)
+        if error:
+            print_formatted(HTML(' ❌ {}/{} - <red>{}, aborting update of app</red>').format(app, service, error))
+            return False
+        print_formatted(f' ✔️ {app}/{service} - updated in {time.monotonic() - start_time:.1f} s')
+    return True
+
+
+def update_apps(docker_clients, apps, interactive=False):
+    """
+    Pulls all images of the given Docker stacks and afterwards recreates the
+    services with changed images stack by stack and service by service.
+    """
+    apps = [app for app in apps if check_if_initial_setup_completed(app)]
+    success = pull_apps(docker_clients, apps, interactive)
+    for app in apps:
+        print_formatted(f'\n *** Updating app {app} *** \n')
+        try:
+            success = update_app(docker_clients, app) and success
+        except FileNotFoundError as e:
+            print_formatted(HTML('<red>{}</red>').format(e))
+            success = False
+        except get_docker_errors() as e:
+            logger.debug('Could not update app %s: %s', app, e)
+            print_formatted(HTML(' ❌ {} - <red>{}</red>').format(app, get_short_error_message(e)))
+            success = False
+    return success
@@ -0,0 +1,319 @@
+"""
+Decides which stacks have to be started and whether the host has enough
+memory for them, and shows the pending changes of all stacks.
+"""
+
+import json
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from .common import (HTML, STARTUP_ORDER, basic_configuration, check_if_initial_setup_completed, get_max_workers,
+                     get_short_error_message, logger, print_formatted, write_file_atomically)
+from .compose_files import find_all_secrets, find_service_images, get_compose_index, parse_memory_size, read_env_file
+from .configuration import get_env_template, is_setup_up_to_date
+from .docker_engine import DockerEngineClient, get_docker_errors, get_docker_reader, query_all_containers
+
+
+RESOURCE_USAGE_FILE = '.resource_usage.json'
+# memory kept free for the host and assumed per service, if nothing is known about a stack
+MEMORY_RESERVE = 512 * 1024 ** 2
+DEFAULT_SERVICE_MEMORY = 256 * 1024 ** 2
+
+
+def is_app_in_desired_state(app, containers):
+    """
+    Checks whether all services of an app are running with the configuration
+    Docker Compose would create now, by comparing the expected config hashes
+    with the label "com.docker.compose.config-hash" of the containers. In
+    this case "docker compose up" would not change anything. The config
+    hashes are only needed, if every service has running containers.
+    """
+    try:
+        entry = get_compose_index().get(app)
+        if (not entry or any(c.state != 'running' for c in containers)
+                or not set(entry['services']) <= {c.service for c in containers}):
+            return False
+        config_hashes = get_compose_index().get_config_hashes(app)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.debug('Could not compute config hashes of app %s: %s', app, e)
+        return False
+    if not config_hashes:
+        return False
+    for service, config_hash in config_hashes.items():
+        service_containers = [c for c in containers if c.service == service]
+        if not service_containers or any(c.state != 'running' or c.config_hash != config_hash
+                                         for c in service_containers):
+            return False
+    return True
+
+
+def find_apps_in_desired_state(apps, all_containers):
+    """
+    Finds all apps that are already running with their current configuration
+    and can be skipped when starting. The apps are checked concurrently.
+    """
+    with ThreadPoolExecutor(max_workers=get_max_workers()) as executor:
+        results = list(executor.map(lambda app: is_app_in_desired_state(app, all_containers[app]), apps))
+    return [app for app, result in zip(apps, results) if result]
+
+
+def read_available_memory():
+    """Reads the memory available for starting new processes from /proc/meminfo or None if unknown."""
+    try:
+        with open('/proc/meminfo', 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError) as e:
+        logger.debug('Could not read available memory: %s', e)
+    return None
+
+
+def load_resource_usage():
+    """Loads the highest memory usage of every stack that has been observed so far."""
+    try:
+        with open(RESOURCE_USAGE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_resource_usage(usage):
+    """Writes the observed memory usage of all stacks to disk."""
+    try:
+        write_file_atomically(RESOURCE_USAGE_FILE, json.dumps(usage))
+    except OSError as e:
+        logger.debug('Could not save resource usage: %s', e)
+
+
+def query_memory_usage(reader, all_containers):
+    """Queries the current memory usage of all running containers and sums it up per stack."""
+    running = {c.name: app for app, containers in all_containers.items() for c in containers if c.state == 'running'}
+    usage = {}
+    if not running:
+        return usage
+    if isinstance(reader, DockerEngineClient):
+        with ThreadPoolExecutor(max_workers=reader.MAX_CONNECTIONS) as executor:
+            stats = dict(zip(running, executor.map(reader.container_stats, running)))
+        for name, stat in stats.items():
+            memory = stat.get('memory_stats') or {}
+            # like the docker CLI, do not count the page cache as used memory
+            cache = (memory.get('stats') or {}).get('inactive_file', (memory.get('stats') or {}).get('cache', 0))
+            usage[running[name]] = usage.get(running[name], 0) + max(memory.get('usage', 0) - cache, 0)
+    else:
+        for stat in reader.container.stats(all=False):
+            app = running.get(stat.container_name)
+            if app:
+                usage[app] = usage.get(app, 0) + stat.memory_used
+    return usage
+
+
+def estimate_memory(app, learned_usage):
+    """
+    Estimates the memory a stack needs. The estimate is taken from the file
+    .initialized (table "memory"), from memory reservations or limits
+    declared in the Docker Compose file, from the highest usage observed so
+    far or a default value per service, in this order. Returns the estimate
+    in bytes and its source.
+    """
+    configured = parse_memory_size((basic_configuration.get('memory') or {}).get(app))
+    if configured:
+        return configured, 'configured'
+    services = get_compose_index().get(app)['services'].values()
+    declared = [config.get('memory') for config in services]
+    if declared and all(declared):
+        return sum(declared), 'declared'
+    if app in learned_usage:
+        return learned_usage[app], 'observed'
+    return sum(memory or DEFAULT_SERVICE_MEMORY for memory in declared), 'default'
+
+
+def update_learned_usage(all_containers):
+    """
+    Queries the memory usage of all running stacks and remembers the highest
+    usage of every stack for later estimates. Returns the learned usage.
+    """
+    learned_usage = load_resource_usage()
+    try:
+        observed_usage = query_memory_usage(get_docker_reader(), all_containers)
+    except get_docker_errors() as e:
+        logger.debug('Could not query memory usage of containers: %s', e)
+        return learned_usage
+    if observed_usage:
+        for app, usage in observed_usage.items():
+            learned_usage[app] = max(usage, learned_usage.get(app, 0))
+        save_resource_usage(learned_usage)
+    return learned_usage
+
+
+def output_capacity_report(available, estimates, refused):
+    """Outputs the memory estimates of all stacks that should be started and which of them are refused."""
+    mib = 1024 ** 2
+    print_formatted(f'\n *** Not enough memory for all stacks ({available // mib} MiB available, '
+                    f'{MEMORY_RESERVE // mib} MiB kept free for the host) *** \n')
+    for app, (estimate, source) in estimates.items():
+        mark = '❌' if app in refused else '✔️'
+        print_formatted(f' {mark} {app:<20} {estimate // mib:>6} MiB ({source})')
+    print_formatted(HTML('\n<red>Refused to start: {}</red>').format(', '.join(refused)))
+    print_formatted('Stop other stacks first, start them later or use "--ignore-memory" to start them anyway.\n')
+
+
+def check_host_capacity(apps, all_containers):
+    """
+    Checks which of the given stacks fit into the memory available on the
+    host before they are started. Stacks with running containers already use
+    their memory and are always admitted. Only if other stacks have to be
+    started, the memory usage of all running stacks is observed and
+    remembered for later estimates. Stacks that do not fit are refused and
+    reported together with their estimates. Returns the admitted stacks.
+    """
+    stopped_apps = [app for app in apps if not any(c.state == 'running' for c in all_containers.get(app, []))]
+    available = read_available_memory() if stopped_apps else None
+    if available is None:
+        return apps
+    learned_usage = update_learned_usage(all_containers)
+    free = available - MEMORY_RESERVE
+    refused, estimates = [], {}
+    # stacks from STARTUP_ORDER are needed by all others and are admitted first
+    order = {app: i for i, app in enumerate(STARTUP_ORDER)}
+    for app in sorted(stopped_apps, key=lambda app: order.get(app, len(order))):
+        estimates[app] = estimate_memory(app, learned_usage)
+        if estimates[app][0] <= free:
+            free -= estimates[app][0]
+        else:
+            refused.append(app)
+    if refused:
+        output_capacity_report(available, estimates, refused)
+    return [app for app in apps if app not in refused]
+
+
+def select_apps_to_start(apps, force=False, ignore_memory=False):
+    """
+    Returns the given stacks that have to be started and those of them that
+    are admitted. Unless forced, stacks that are already running with their
+    current configuration are skipped. Unless the memory check is ignored,
+    the remaining stacks have to fit into the available memory. The
+    containers of all stacks are queried once for both checks.
+    """
+    all_containers = {}
+    if not force or not ignore_memory:
+        try:
+            all_containers = query_all_containers(get_docker_reader())
+        except get_docker_errors() as e:
+            logger.debug('Could not query containers: %s', e)
+    if not force:
+        for app in find_apps_in_desired_state(apps, all_containers) if all_containers else []:
+            print_formatted(f' ✔️ {app} - already running with the current configuration')
+            apps = [a for a in apps if a != app]
+    if ignore_memory or not apps:
+        return apps, apps
+    return apps, check_host_capacity(apps, all_containers)
+
+
+def query_local_images(reader):
+    """Returns the ids of all local images by their tags."""
+    if isinstance(reader, DockerEngineClient):
+        return {tag: image['Id'] for image in reader.list_images() for tag in image.get('RepoTags') or []}
+    return {tag: image.id for image in reader.image.list() for tag in image.repo_tags}
+
+
+def plan_setup(app, env_template):
+    """Returns the pending changes of the setup of an app: missing variables, secrets and changed files."""
+    changes = [('!', f'.env.template: {error}') for error in env_template.errors]
+    existing_variables = read_env_file(app)
+    missing_variables = [v.name for v in env_template.variables
+                         if not v.name.startswith('#') and v.name.strip() not in existing_variables]
+    if missing_variables:
+        changes.append(('~', f'.env: missing {", ".join(missing_variables)}'))
+    missing_secrets = [filename for _, filename in find_all_secrets(app) if not (Path(app) / filename).is_file()]
+    if missing_secrets:
+        changes.append(('+', f'secrets: missing {", ".join(missing_secrets)}'))
+    if not missing_variables and not missing_secrets and not is_setup_up_to_date(app):
+        changes.append(('~', 'setup: template, secrets or generated files changed since last setup'))
+    return changes
+
+
+def plan_service(service, image, service_containers, local_image_id, config_hash):
+    """
+    Returns the pending changes of a single service by comparing its
+    containers with the local image and the expected configuration hash.
+    """
+    changes = []
+    if local_image_id is None:
+        changes.append(('+', f'{service}: image {image} would be pulled'))
+    if not service_containers:
+        changes.append(('+', f'{service}: container would be created'))
+    elif local_image_id and any(c.image_id != local_image_id for c in service_containers):
+        changes.append(('~', f'{service}: would be recreated with newer image {image}'))
+    elif config_hash and any(c.config_hash != config_hash for c in service_containers):
+        changes.append(('~', f'{service}: configuration changed, would be recreated'))
+    elif any(c.state != 'running' for c in service_containers):
+        changes.append(('~', f'{service}: would be started'))
+    return changes
+
+
+def plan_app(app, containers, local_images):
+    """
+    Computes all pending changes for a single app without changing anything.
+    Returns a list of changes, each one consisting of a marker ("+" for
+    things that would be created, "~" for changes, "-" for things that would
+    be removed and "!" for problems) and a description.
+    """
+    if not check_if_initial_setup_completed(app):
+        return [('+', 'setup: app has not been set up yet')]
+    try:
+        changes = plan_setup(app, get_env_template(app))
+    except OSError as e:
+        return [('!', f'setup: {e}')]
+    try:
+        config_hashes = get_compose_index().get_config_hashes(app)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.debug('Could not compute config hashes of app %s: %s', app, e)
+        changes.append(('!', 'could not compute configuration hashes with Docker Compose'))
+        config_hashes = {}
+    for service, image in find_service_images(app).items():
+        service_containers = [c for c in containers if c.service == service]
+        changes.extend(plan_service(service, image, service_containers, local_images.get(image),
+                                    config_hashes.get(service)))
+    services = get_compose_index().get(app)['services']
+    changes.extend(('-', f'{c.service}: orphaned container {c.name}') for c in containers if c.service not in services)
+    return changes
+
+
+def output_plan(plans):
+    """Outputs the pending changes of all apps with colored markers."""
+    colors = {'+': 'green', '~': 'orange', '-': 'red', '!': 'red'}
+    print_formatted(f' *** Plan for {len(plans)} apps *** \n')
+    for app, changes in plans.items():
+        if not changes:
+            print_formatted(f' ✔️ {app} - up to date')
+            continue
+        print_formatted(f' ● {app}')
+        for marker, description in changes:
+            color = colors[marker]
+            print_formatted(HTML(f'    <{color}>{{}} {{}}</{color}>').format(marker, description))
+    pending = [app for app, changes in plans.items() if changes]
+    print_formatted(f'\n{len(pending)} of {len(plans)} apps have pending changes.')
+
+
+def plan_apps(apps):
+    """
+    Computes and outputs all pending changes for the given apps without
+    changing anything: apps that have not been set up, missing variables
+    and secrets, images that would be pulled and containers that would be
+    created, recreated or started. The state of all containers and images is
+    queried once, the apps are planned concurrently.
+    """
+    reader = get_docker_reader()
+    try:
+        all_containers = query_all_containers(reader)
+        local_images = query_local_images(reader)
+    except get_docker_errors() as e:
+        print_formatted(HTML('<red>Could not query Docker: {}</red>').format(get_short_error_message(e)))
+        return False
+    with ThreadPoolExecutor(max_workers=get_max_workers()) as executor:
+        futures = {app: executor.submit(plan_app, app, all_containers[app], local_images) for app in apps}
+        plans = {app: future.result() for app, future in futures.items()}
+    output_plan(plans)
+    return True
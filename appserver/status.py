@@ -0,0 +1,400 @@
+"""
+Outputs the status of all stacks as text, JSON or in the Prometheus text
+exposition format, reports the durations of all operations from the events
+log and serves both as metrics exporter.
+"""
+
+import os
+import json
+import time
+import math
+import threading
+from pathlib import Path
+from datetime import datetime, timezone
+
+from .common import (EVENTS_LOG_FILE, HTML, app_name_map, check_if_initial_setup_completed, get_short_error_message,
+                     logger, print_formatted, runtime, select_apps, timed_step)
+from .docker_engine import DockerEngineClient, get_docker_errors, get_docker_reader, query_all_containers
+
+
+EXPORTER_ADDRESS = '127.0.0.1:9787'
+OPERATION_BUCKETS = (1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+DOCKER_API_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def format_duration(seconds):
+    """Returns a short human readable representation of a given duration."""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    if days:
+        return f'{days}d {hours}h'
+    if hours:
+        return f'{hours}h {minutes}m'
+    return f'{minutes}m {seconds}s'
+
+
+def format_container_info(c):
+    """Returns a line with state, health, uptime and restart count of a given container."""
+    color = 'ansigreen' if c.state == 'running' else '#ffcc00'
+    if c.health == 'unhealthy':
+        color = 'ansired'
+    template = '    - {} <style color="' + color + '">{}</style>'
+    values = [c.name, f'{c.state} ({c.health})' if c.health else c.state]
+    if c.state == 'running' and c.started_at:
+        template += ' - up {}'
+        values.append(format_duration((datetime.now(timezone.utc) - c.started_at).total_seconds()))
+    if c.restart_count:
+        template += ' - <ansired>{} restarts</ansired>'
+        values.append(c.restart_count)
+    return HTML(template).format(*values)
+
+
+def query_image_creation_times(docker_client, all_containers):
+    """Queries the creation time of the images of all given containers with a single call."""
+    image_ids = {c.image_id for containers in all_containers.values() for c in containers if c.image_id}
+    if not image_ids:
+        return {}
+    try:
+        if isinstance(docker_client, DockerEngineClient):
+            return {image['Id']: datetime.fromtimestamp(image['Created'], timezone.utc)
+                    for image in docker_client.list_images() if image['Id'] in image_ids}
+        return {image.id: image.created for image in docker_client.image.inspect(list(image_ids))}
+    except get_docker_errors() as e:
+        logger.debug('Could not inspect images: %s', e)
+        return {}
+
+
+def format_status_as_json(all_containers, image_created):
+    """Returns status information about all stacks and their respective containers as JSON."""
+    status = {}
+    for app, description in app_name_map.items():
+        containers = []
+        for c in all_containers[app]:
+            container = c._replace(started_at=c.started_at.isoformat() if c.started_at else None)._asdict()
+            created = image_created.get(c.image_id)
+            container['image_created'] = created.isoformat() if created else None
+            containers.append(container)
+        status[app] = {'description': description, 'initialized': check_if_initial_setup_completed(app),
+                       'containers': containers}
+    return json.dumps(status, indent=2)
+
+
+def get_container_samples(c, image_created, now):
+    """
+    Returns the values of all metrics for a single container as tuples of the
+    name of the metric and its value. Metrics without a value for the
+    container are left out.
+    """
+    values = [('schoolappserver_container_running', int(c.state == 'running'))]
+    if c.health:
+        values.append(('schoolappserver_container_healthy', int(c.health == 'healthy')))
+    values.append(('schoolappserver_container_restarts', c.restart_count))
+    if c.state == 'running' and c.started_at:
+        values.append(('schoolappserver_container_uptime_seconds', round((now - c.started_at).total_seconds())))
+    if image_created.get(c.image_id):
+        values.append(('schoolappserver_container_image_age_seconds',
+                       round((now - image_created[c.image_id]).total_seconds())))
+    return values
+
+
+def create_status_metrics(all_containers, image_created):
+    """Returns the metric families with status information about all stacks and their containers."""
+    from prometheus_client.core import GaugeMetricFamily  # pylint: disable=import-outside-toplevel
+    now = datetime.now(timezone.utc)
+    stack_metrics = {
+        'schoolappserver_stack_initialized': 'Whether the stack has been set up',
+        'schoolappserver_stack_containers': 'Number of containers of the stack',
+        'schoolappserver_stack_healthy': 'Whether all containers of the stack are running and healthy',
+    }
+    container_metrics = {
+        'schoolappserver_container_running': 'Whether the container is running',
+        'schoolappserver_container_healthy': 'Health of the container (1 healthy, 0 unhealthy or starting, '
+                                             'missing without healthcheck)',
+        'schoolappserver_container_restarts': 'Number of restarts of the container',
+        'schoolappserver_container_uptime_seconds': 'Time since the container has been started',
+        'schoolappserver_container_image_age_seconds': 'Time since the image of the container has been created',
+    }
+    metrics = {name: GaugeMetricFamily(name, description, labels=['stack'])
+               for name, description in stack_metrics.items()}
+    metrics.update({name: GaugeMetricFamily(name, description, labels=['stack', 'service', 'container'])
+                    for name, description in container_metrics.items()})
+    for app in app_name_map:
+        containers = all_containers[app]
+        healthy = bool(containers) and all(c.state == 'running' and c.health != 'unhealthy' for c in containers)
+        metrics['schoolappserver_stack_initialized'].add_metric([app], int(check_if_initial_setup_completed(app)))
+        metrics['schoolappserver_stack_containers'].add_metric([app], len(containers))
+        metrics['schoolappserver_stack_healthy'].add_metric([app], int(healthy))
+        for c in containers:
+            for name, value in get_container_samples(c, image_created, now):
+                metrics[name].add_metric([app, c.service, c.name], value)
+    return list(metrics.values())
+
+
+class MetricFamilies:
+    """Collector for a registry of prometheus_client that returns a fixed list of metric families."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def describe(self):
+        """Describes the metrics without collecting them again."""
+        return self.metrics
+
+    def collect(self):
+        """Returns all metric families."""
+        return self.metrics
+
+
+def format_status_as_prometheus(all_containers, image_created):
+    """
+    Returns status information about all stacks and their respective
+    containers in the Prometheus text exposition format.
+    """
+    from prometheus_client import CollectorRegistry, generate_latest  # pylint: disable=import-outside-toplevel
+    registry = CollectorRegistry()
+    registry.register(MetricFamilies(create_status_metrics(all_containers, image_created)))
+    return generate_latest(registry).decode('utf-8')
+
+
+def output_status(output_format='text'):
+    """
+    Outputs status information about all stacks and their respective
+    containers. Besides human readable text, JSON and the Prometheus text
+    exposition format are supported for monitoring.
+    """
+    docker_client = get_docker_reader()
+    if runtime.status_cache and runtime.status_cache.is_populated():
+        all_containers = runtime.status_cache.get_containers()
+    else:
+        try:
+            with timed_step('query_containers'):
+                all_containers = query_all_containers(docker_client, details=True)
+        except get_docker_errors() as e:
+            logger.debug('Could not query containers: %s', e)
+            print_formatted(HTML('<red>Could not query Docker: {}</red>').format(get_short_error_message(e)))
+            return False
+    if output_format in ('json', 'prometheus'):
+        with timed_step('query_images'):
+            image_created = query_image_creation_times(docker_client, all_containers)
+        if output_format == 'json':
+            print(format_status_as_json(all_containers, image_created))
+        else:
+            print(format_status_as_prometheus(all_containers, image_created), end='')
+        return True
+    print_formatted(' *** Stacks and Container *** \n')
+    for app, description in app_name_map.items():
+        if check_if_initial_setup_completed(app):
+            container = all_containers[app]
+            mark = '✔️' if any(c.state == 'running' for c in container) else '❌'
+            print_formatted(f' {mark} {description} {"⣿" * len(container)}')
+            for c in container:
+                print_formatted(format_container_info(c))
+        else:
+            print_formatted(HTML(f' ❌ {description} - <style color="#ffcc00">Not yet initialized!</style>'))
+    return True
+
+
+def get_status_format(args):
+    """
+    Returns the output format given as arguments of the command "status"
+    ("--format json", "--format=prometheus" or "--json") or None if the given
+    format is not supported.
+    """
+    output_format = 'json' if '--json' in args else 'text'
+    for i, arg in enumerate(args):
+        if arg == '--format' and i + 1 < len(args):
+            output_format = args[i + 1]
+        elif arg.startswith('--format='):
+            output_format = arg.split('=', 1)[1]
+    if output_format not in ('text', 'json', 'prometheus'):
+        print_formatted(HTML('<red>Invalid output format: {}</red>').format(output_format))
+        return None
+    return output_format
+
+
+def read_all_events():
+    """Reads all events from the events log including all rotated files, oldest first."""
+    rotated_files = [path for path in Path('.').glob(f'{EVENTS_LOG_FILE}.*') if path.suffix[1:].isdigit()]
+    rotated_files.sort(key=lambda path: int(path.suffix[1:]), reverse=True)
+    events = []
+    for path in rotated_files + [Path(EVENTS_LOG_FILE)]:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        logger.debug('Invalid line in events log %s: %s', path, line)
+        except FileNotFoundError:
+            continue
+    return events
+
+
+def percentile(values, p):
+    """Returns the p-th percentile of the given sorted values by the nearest-rank method."""
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def output_durations(title, groups):
+    """Outputs count, failures and p50, p95 and maximum of the durations for each group."""
+    print_formatted(f'\n *** {title} *** \n')
+    print_formatted(f' {"":<38} {"count":>6} {"failed":>6} {"p50":>8} {"p95":>8} {"max":>8}')
+    rows = []
+    for name, events in groups.items():
+        durations = sorted(e['duration'] for e in events)
+        failed = sum(1 for e in events if not e.get('success', True))
+        rows.append((name, len(durations), failed, percentile(durations, 50),
+                     percentile(durations, 95), durations[-1]))
+    for name, count, failed, p50, p95, maximum in sorted(rows, key=lambda row: row[4], reverse=True):
+        print_formatted(f' {name:<38} {count:>6} {failed:>6} {p50:>7.2f}s {p95:>7.2f}s {maximum:>7.2f}s')
+
+
+def output_report(args):
+    """
+    Outputs a report about the duration of all recorded operations from the
+    events log. Operations like starting or pulling are summarized per stack,
+    all operations and their steps (parsing compose files, hashing passwords,
+    calling Docker Compose, pulling images, ...) across all stacks. The report
+    can be limited to some apps. The slowest entries are shown first.
+    """
+    apps = select_apps(args) if args else None
+    if apps is None and args:
+        return False
+    events = [e for e in read_all_events() if e.get('duration') is not None]
+    if apps is not None:
+        events = [e for e in events if e.get('app') in apps]
+    if not events:
+        print_formatted('No operations have been recorded yet.')
+        return True
+    per_stack = {}
+    per_step = {}
+    for event in events:
+        if event.get('app') and 'parent' not in event:
+            per_stack.setdefault(f'{event["app"]} - {event["operation"]}', []).append(event)
+        per_step.setdefault(event['operation'], []).append(event)
+    print_formatted(f' *** Report for {len(events)} recorded operations since {events[0]["time"][:19]} *** ')
+    if per_stack:
+        output_durations('Operations per stack', per_stack)
+    output_durations('Operations and steps', per_step)
+    return True
+
+
+class MetricsExporter:
+    """
+    Collects metrics about SchoolAppServer for the registry of
+    prometheus_client. Operations are read incrementally from the events log
+    that is written by all instances of SchoolAppServer. The status of all
+    stacks is queried from Docker on every scrape, while the creation times
+    of images are cached, because images never change.
+    """
+
+    def __init__(self, docker_client):
+        from prometheus_client import Counter, Histogram  # pylint: disable=import-outside-toplevel
+        self.docker_client = docker_client
+        # inode and offset of the events log up to which all events have been read
+        self.events_position = (None, 0)
+        self.image_created = {}
+        # the metrics are not registered globally, they are returned by collect()
+        self.operation_duration = Histogram(
+            'schoolappserver_operation_duration_seconds',
+            'Duration of operations like starting, stopping, pulling or setting up stacks',
+            ['operation', 'stack'], buckets=OPERATION_BUCKETS, registry=None)
+        self.operation_failures = Counter(
+            'schoolappserver_operation_failures', 'Number of failed operations', ['operation', 'stack'], registry=None)
+        self.docker_api_latency = Histogram(
+            'schoolappserver_docker_api_latency_seconds', 'Latency of calls to the Docker API', ['call'],
+            buckets=DOCKER_API_BUCKETS, registry=None)
+        self.lock = threading.Lock()
+
+    def read_events(self):
+        """Reads all new events from the events log, also after it has been rotated."""
+        try:
+            stat = os.stat(EVENTS_LOG_FILE)
+        except FileNotFoundError:
+            return
+        inode, offset = self.events_position
+        if stat.st_ino != inode or stat.st_size < offset:
+            offset = 0
+        with open(EVENTS_LOG_FILE, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        # only handle complete lines, the last line may still be written
+        data = data[:data.rfind(b'\n') + 1]
+        self.events_position = (stat.st_ino, offset + len(data))
+        for line in data.splitlines():
+            try:
+                event = json.loads(line)
+            except ValueError:
+                logger.debug('Invalid line in events log: %s', line)
+                continue
+            labels = (event.get('operation'), event.get('app') or '')
+            if event.get('duration') is not None:
+                self.operation_duration.labels(*labels).observe(event['duration'])
+            if not event.get('success', True):
+                self.operation_failures.labels(*labels).inc()
+
+    def timed_call(self, call, function, *args, **kwargs):
+        """Calls a function querying the Docker API and measures its latency."""
+        start_time = time.monotonic()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.docker_api_latency.labels(call).observe(time.monotonic() - start_time)
+
+    def describe(self):
+        """Describes no metrics, so that the registry does not query Docker when the exporter is registered."""
+        return []
+
+    def collect(self):
+        """Returns all metrics, the status of all stacks is queried from Docker."""
+        from prometheus_client.core import GaugeMetricFamily  # pylint: disable=import-outside-toplevel
+        with self.lock:
+            self.read_events()
+            metrics = []
+            docker_up = GaugeMetricFamily('schoolappserver_docker_up', 'Whether the Docker API could be queried')
+            try:
+                all_containers = self.timed_call('container_list', query_all_containers, self.docker_client,
+                                                 details=True)
+                new_images = {app: [c for c in containers if c.image_id not in self.image_created]
+                              for app, containers in all_containers.items()}
+                if any(new_images.values()):
+                    self.image_created.update(self.timed_call(
+                        'image_inspect', query_image_creation_times, self.docker_client, new_images))
+                metrics.extend(create_status_metrics(all_containers, self.image_created))
+                docker_up.add_metric([], 1)
+            except get_docker_errors() as e:
+                logger.debug('Could not query containers for metrics: %s', e)
+                docker_up.add_metric([], 0)
+            metrics.append(docker_up)
+            for metric in (self.operation_duration, self.operation_failures, self.docker_api_latency):
+                metrics.extend(metric.collect())
+            return metrics
+
+
+def serve_metrics(args):
+    """
+    Runs the metrics exporter as daemon, which serves all metrics for
+    Prometheus over HTTP until it is interrupted. The address to listen on can
+    be given as "--listen host:port".
+    """
+    from prometheus_client import CollectorRegistry, start_http_server  # pylint: disable=import-outside-toplevel
+    listen = args[args.index('--listen') + 1] if '--listen' in args[:-1] else EXPORTER_ADDRESS
+    host, _, port = listen.rpartition(':')
+    if not port.isdigit():
+        print_formatted(HTML('<red>Invalid address to listen on: {}</red>').format(listen))
+        return False
+    registry = CollectorRegistry()
+    registry.register(MetricsExporter(get_docker_reader()))
+    try:
+        start_http_server(int(port), addr=host or '0.0.0.0', registry=registry)
+    except OSError as e:
+        print_formatted(HTML('<red>Could not listen on {}: {}</red>').format(listen, e))
+        return False
+    print_formatted(f'Serving metrics on http://{host or "0.0.0.0"}:{port}/metrics')
+    try:
+        # the server runs in a daemon thread, so wait here until interrupted
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    return True
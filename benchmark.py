@@ -0,0 +1,528 @@
+#! /usr/bin/env python3
+
+"""
+Benchmarks the hot paths of the SchoolAppServer management tool offline
+against a synthetic tree of N stacks. Docker is replaced by a mocked client,
+so no Docker daemon is necessary. The backend for the Docker Engine API is
+measured against a fake API server on a Unix socket. Each benchmark is executed several times
+and the median duration is reported for every number of stacks, to see how
+the tool scales when more stacks are added. The startup time of short
+commands is measured by starting the tool as new process, which also checks
+that no heavy module is imported needlessly.
+
+Execute the benchmarks with pipenv:
+
+    pipenv run python benchmark.py
+    pipenv run python benchmark.py --stacks 29,100,500 --repeat 5 --only "find_all_secrets*"
+
+To catch regressions, save the results of a run and compare later runs with
+them. The script exits with code 1, if a benchmark got slower than allowed or
+a command imported a heavy module it does not need:
+
+    pipenv run python benchmark.py --save baseline.json
+    pipenv run python benchmark.py --compare baseline.json --tolerance 0.25
+
+"""
+
+import re
+import os
+import sys
+import json
+import time
+import fnmatch
+import tempfile
+import threading
+import statistics
+import subprocess
+import socketserver
+from pathlib import Path
+from contextlib import contextmanager, ExitStack
+from unittest import mock
+from datetime import datetime, timezone
+from argparse import ArgumentParser
+from urllib.parse import urlparse
+from http.server import BaseHTTPRequestHandler
+
+from appserver import common, compose_files, configuration, docker_engine, status, planning, operations
+
+
+COMPOSE_TEMPLATE = """services:
+  app:
+    image: ${{{prefix}_APP_IMAGE}}
+    restart: unless-stopped
+    labels:
+      - "traefik.enable=true"
+      - "traefik.http.routers.{app}.rule=Host(`${{{prefix}_DOMAIN}}`)"
+      - "traefik.http.routers.{app}.entrypoints=websecure"
+    volumes:
+      - {app}_data:/data
+    secrets:
+      - {app}_db_password
+      - {app}_admin_password
+  db:
+    image: ${{{prefix}_DB_IMAGE}}
+    restart: unless-stopped
+    volumes:
+      - {app}_db:/var/lib/postgresql/data
+    secrets:
+      - {app}_db_password
+  cache:
+    image: redis:7
+
+secrets:
+  {app}_db_password:
+    file: ./secrets/db_password.txt
+  {app}_admin_password:
+    file: ./secrets/admin_password.txt
+
+volumes:
+  {app}_data:
+  {app}_db:
+"""
+
+ENV_TEMPLATE = """{prefix}_APP_IMAGE=example/app{image}:latest
+{prefix}_DB_IMAGE=postgres:16
+{prefix}_DOMAIN={{{lower}_domain}}
+{prefix}_DB_PASSWORD={{db_password}}
+{prefix}_ADMIN_PASSWORD={{admin_password}}
+{prefix}_ADMIN_USER={{admin_user}}
+{prefix}_TIMEZONE={{timezone}}
+"""
+
+SCRIPT = Path(__file__).resolve().with_name('school_app_server.py')
+
+# short commands measured as new process and the heavy modules they must not import
+STARTUP_COMMANDS = {
+    'startup (--version)': (['--version'], ['yaml', 'bcrypt', 'argon2', 'python_on_whales', 'prompt_toolkit',
+                                            'prometheus_client']),
+    'startup (status json, engine api)': (['--backend', 'api', 'status', '--format', 'json'],
+                                          ['bcrypt', 'argon2', 'python_on_whales', 'prompt_toolkit',
+                                           'prometheus_client']),
+}
+
+CONFIG_TEMPLATE = """settings:
+  name: {app}
+  admin: mail@example.com
+  notifications:
+    sender: mail@example.com
+    interval: 3600
+""" + ''.join(f'  option_{i}: value_{i}\n' for i in range(50))
+
+
+def create_synthetic_tree(root, count):
+    """
+    Creates a tree with the given number of stacks like the ones of the repo.
+    Each stack has a Docker Compose file with three services, two secrets and
+    a template for the environment variables as well as two configuration
+    files containing the example mail address. Returns the names of all
+    stacks and the subdomain map for their domain variables.
+    """
+    app_name_map = {}
+    subdomain_map = {}
+    for i in range(count):
+        app = f'stack{i:03d}'
+        prefix = app.upper()
+        path = Path(root) / app
+        (path / 'secrets').mkdir(parents=True)
+        (path / 'docker-compose.yml').write_text(COMPOSE_TEMPLATE.format(app=app, prefix=prefix), encoding='utf-8')
+        # images are shared between stacks like images of databases in the real tree
+        (path / configuration.ENV_FILE_TEMPLATE_FILENAME).write_text(
+            ENV_TEMPLATE.format(prefix=prefix, lower=app, image=i % 20), encoding='utf-8')
+        (path / '.env').write_text('', encoding='utf-8')
+        (path / common.INITIAL_SETUP_MARKER_FILE).write_text('', encoding='utf-8')
+        write_config_files(root, app)
+        app_name_map[app] = f'Synthetic stack {i}'
+        subdomain_map[f'{prefix}_DOMAIN'] = app
+    Path(root, common.INITIAL_SETUP_MARKER_FILE).write_text('', encoding='utf-8')
+    return app_name_map, subdomain_map
+
+
+def write_config_files(root, app):
+    """Writes the configuration files of a stack, which contain the example mail address."""
+    for name in ('settings.yml', 'mail.yml'):
+        (Path(root) / app / name).write_text(CONFIG_TEMPLATE.format(app=app), encoding='utf-8')
+
+
+class FakeComposeCommands:  # pylint: disable=too-few-public-methods
+    """Replaces the Docker Compose commands of python_on_whales with a fixed latency per call."""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def up(self, **kwargs):  # pylint: disable=invalid-name,unused-argument
+        """Simulates starting a stack."""
+        time.sleep(self.latency)
+
+
+class FakeContainer:  # pylint: disable=too-few-public-methods
+    """
+    Replaces a container of python_on_whales, which is loaded lazily: after
+    listing only its id is known and reading any other attribute inspects the
+    container with another call.
+    """
+
+    def __init__(self, commands, container_id):
+        self.id = container_id  # pylint: disable=invalid-name
+        self.commands = commands
+
+    def __getattr__(self, name):
+        details = self.commands.inspect([self.id])[0]
+        attributes = {re.sub(r'(?<!^)(?=[A-Z])', '_', key).lower(): value for key, value in details.items()}
+        try:
+            return attributes[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+class FakeContainerCommands:
+    """Replaces the container commands of python_on_whales with containers of all synthetic stacks."""
+
+    def __init__(self, apps, latency):
+        self.latency = latency
+        started_at = datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+        # detailed information of every container like it is returned by "docker container inspect"
+        self.details = {}
+        for i, app in enumerate(apps):
+            for service in ('app', 'db', 'cache'):
+                labels = {'com.docker.compose.project': app, 'com.docker.compose.service': service,
+                          'com.docker.compose.config-hash': f'{app}-{service}'}
+                state = {'Status': 'running', 'StartedAt': started_at}
+                if service == 'db':
+                    state['Health'] = {'Status': 'healthy'}
+                self.details[f'{app}-{service}-1'] = {
+                    'Id': f'{app}-{service}-1', 'Name': f'/{app}-{service}-1', 'Image': f'sha256:{i % 20:064d}',
+                    'RestartCount': i % 3, 'Config': {'Labels': labels, 'Image': f'example/{service}:latest'},
+                    'State': state}
+
+    def list(self, **kwargs):  # pylint: disable=unused-argument
+        """Simulates listing all containers with a single call, the containers are inspected lazily."""
+        time.sleep(self.latency)
+        return [FakeContainer(self, container_id) for container_id in self.details]
+
+    def inspect(self, container_ids):
+        """Simulates inspecting the given containers with a single call."""
+        time.sleep(self.latency)
+        return [self.details[container_id] for container_id in container_ids]
+
+
+class FakeDockerClient:  # pylint: disable=too-few-public-methods
+    """Replaces the DockerClient of python_on_whales for all synthetic stacks."""
+
+    def __init__(self, apps, latency):
+        self.compose = FakeComposeCommands(latency)
+        self.container = FakeContainerCommands(apps, latency)
+
+
+def summarize_container(details):
+    """Returns the summary of a container like it is listed by the Docker Engine API."""
+    health = details['State'].get('Health')
+    return {'Id': details['Id'], 'Names': [details['Name']], 'Image': details['Config']['Image'],
+            'ImageID': details['Image'], 'Labels': details['Config']['Labels'], 'State': details['State']['Status'],
+            'Status': 'Up 5 minutes' + (f' ({health["Status"]})' if health else '')}
+
+
+class FakeDockerApiHandler(BaseHTTPRequestHandler):
+    """Answers requests to the Docker Engine API with the containers of all synthetic stacks."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Answers the requests for listing and inspecting containers and images."""
+        path = urlparse(self.path).path
+        parts = path.strip('/').split('/')
+        if path == '/containers/json':
+            body = [summarize_container(details) for details in self.server.inspect.values()]
+        elif len(parts) == 3 and parts[0] == 'containers' and parts[2] == 'json' and parts[1] in self.server.inspect:
+            body = self.server.inspect[parts[1]]
+        elif path == '/images/json':
+            body = [{'Id': f'sha256:{i:064d}', 'Created': 1700000000 + i, 'RepoTags': [f'example/app{i}:latest']}
+                    for i in range(20)]
+        else:
+            body = {'message': f'page not found: {path}'}
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(404 if 'message' in body else 200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def address_string(self):
+        return self.server.server_address
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class FakeDockerApiServer(socketserver.ThreadingUnixStreamServer):
+    """Serves a fake Docker Engine API on a Unix socket in a background thread."""
+    daemon_threads = True
+
+    def __init__(self, socket_path, details):
+        super().__init__(socket_path, FakeDockerApiHandler)
+        self.inspect = details
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+def fake_config_hashes(latency):
+    """Returns a replacement for calculating config hashes with Docker Compose, which matches all containers."""
+    def query_config_hashes(app):
+        time.sleep(latency)
+        return {service: f'{app}-{service}' for service in ('app', 'db', 'cache')}
+    return query_config_hashes
+
+
+def measure(function, setup=None, repeat=5):
+    """Executes a function several times and returns the median duration in seconds."""
+    durations = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start_time = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start_time)
+    return statistics.median(durations)
+
+
+def reset_compose_index():
+    """Drops the index of all Docker Compose files, so that all files are parsed again."""
+    common.runtime.compose_index = compose_files.ComposeIndex()
+
+
+def reset_config_files(apps):
+    """Restores all configuration files with the example mail address and drops the placeholder index."""
+    for app in apps:
+        write_config_files('.', app)
+    Path(configuration.PLACEHOLDER_INDEX_FILE).unlink(missing_ok=True)
+
+
+def write_all_env_files(apps):
+    """Generates the environment variables of all stacks from their templates and writes them."""
+    for app in apps:
+        with common.FileTransaction() as transaction:
+            template, parameters = configuration.collect_env_parameters(app)
+            configuration.write_env_file(transaction, app, template, parameters)
+
+
+def replace_mail_address():
+    """Replaces the example mail address in the configuration files of all stacks."""
+    configuration.replace_mail_address_in_files('admin@school.example')
+
+
+def output_status(docker_client, formatter):
+    """Queries all containers and formats the status of all stacks like the command "status"."""
+    all_containers = docker_engine.query_all_containers(docker_client, details=True)
+    formatter(all_containers, {})
+
+
+def scaled_benchmarks(apps, docker_client, engine_client):
+    """Returns all benchmarks whose duration depends on the number of stacks."""
+    docker_clients = {app: docker_client for app in apps}
+    return {
+        'find_all_secrets (cold)': (compose_files.find_all_secrets, reset_compose_index),
+        'find_all_secrets (warm)': (compose_files.find_all_secrets, None),
+        'replace_mail_address_in_files': (replace_mail_address, lambda: reset_config_files(apps)),
+        'replace_mail_address_in_files (done)': (replace_mail_address, None),
+        'generate env files': (lambda: write_all_env_files(apps), None),
+        'status (text)': (lambda: [status.format_container_info(c) for containers in
+                                   docker_engine.query_all_containers(docker_client, details=True).values()
+                                   for c in containers], None),
+        'status (json)': (lambda: output_status(docker_client, status.format_status_as_json), None),
+        'status (prometheus)': (lambda: output_status(docker_client, status.format_status_as_prometheus), None),
+        'status (json, engine api)': (lambda: output_status(engine_client, status.format_status_as_json), None),
+        'query_all_containers (engine api)': (lambda: docker_engine.query_all_containers(engine_client), None),
+        'start_apps (forced)': (lambda: operations.start_apps(docker_clients, apps, force=True, ignore_memory=True),
+                                None),
+        'start_apps (unchanged)': (lambda: operations.start_apps(docker_clients, apps), None),
+    }
+
+
+def fixed_benchmarks():
+    """Returns all benchmarks whose duration does not depend on the number of stacks."""
+    return {
+        'create_password (1000x)': (lambda: [configuration.create_password() for _ in range(1000)], None),
+        'generate_htpasswd_bcrypt': (lambda: configuration.generate_htpasswd_bcrypt('admin', 'password'), None),
+        'generate_argon_password_hash': (lambda: configuration.generate_argon_password_hash('password'), None),
+    }
+
+
+def run_tool(root, args, env):
+    """
+    Executes the tool as new process like it is started from the command line
+    and returns the names of all top-level modules it has imported.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', str(SCRIPT), *args], cwd=root, env=env,
+                            capture_output=True, text=True, check=False)
+    return {line.rsplit('|', 1)[-1].strip().split('.')[0] for line in result.stderr.splitlines()
+            if line.startswith('import time:')}
+
+
+def run_startup_benchmarks(repeat, pattern):
+    """
+    Measures the startup time of short commands in a new process. The status
+    is queried from a fake Docker Engine API without containers. Returns the
+    median durations and, for every command, the heavy modules it has
+    imported although it does not need them.
+    """
+    results, needless_imports = {}, {}
+    with tempfile.TemporaryDirectory(prefix='schoolappserver-startup-') as root:
+        Path(root, common.INITIAL_SETUP_MARKER_FILE).write_text('', encoding='utf-8')
+        socket_path = str(Path(root) / 'docker.sock')
+        server = FakeDockerApiServer(socket_path, {})
+        env = dict(os.environ, DOCKER_HOST=f'unix://{socket_path}')
+        try:
+            for name, (args, heavy_modules) in STARTUP_COMMANDS.items():
+                if not fnmatch.fnmatch(name, pattern):
+                    continue
+                results[name] = {'-': measure(lambda args=args: run_tool(root, args, env), repeat=repeat)}
+                imported_modules = run_tool(root, args, env)
+                needless_imports[name] = [module for module in heavy_modules if module in imported_modules]
+        finally:
+            server.shutdown()
+            server.server_close()
+    return results, needless_imports
+
+
+def patch_tool(**values):
+    """
+    Replaces the given names in all modules of the tool that define or import
+    them, because every module looks them up in its own namespace.
+    """
+    stack = ExitStack()
+    for module in (common, compose_files, configuration, docker_engine, status, planning, operations):
+        for name, value in values.items():
+            if hasattr(module, name):
+                stack.enter_context(mock.patch.object(module, name, value))
+    return stack
+
+
+@contextmanager
+def synthetic_environment(root, count, latency):
+    """
+    Creates a synthetic tree with the given number of stacks and a fake
+    Docker client and Docker Engine API for it. While the context is active,
+    the tool works on this tree. Yields the names of all stacks, the fake
+    Docker client and a client for the fake Docker Engine API.
+    """
+    working_dir = os.getcwd()
+    app_name_map, subdomain_map = create_synthetic_tree(root, count)
+    apps = list(app_name_map)
+    answers = {app: {'admin_user': 'admin', 'timezone': 'Europe/Berlin'} for app in apps}
+    docker_client = FakeDockerClient(apps, latency)
+    socket_path = str(Path(root) / 'docker.sock')
+    server = FakeDockerApiServer(socket_path, docker_client.container.details)
+    os.chdir(root)
+    try:
+        with patch_tool(app_name_map=app_name_map, SUBDOMAIN_MAP=subdomain_map, STARTUP_ORDER=[], answers=answers,
+                        basic_configuration={'domain-name': 'school.example'},
+                        print_formatted=lambda *args, **kwargs: None,
+                        get_docker_reader=lambda *args: docker_client,
+                        inspect_containers=lambda client, ids: client.container.inspect(ids),
+                        query_config_hashes=fake_config_hashes(latency)), \
+                mock.patch.object(common.runtime, 'compose_index', None):
+            yield apps, docker_client, docker_engine.DockerEngineClient(socket_path)
+    finally:
+        os.chdir(working_dir)
+        server.shutdown()
+        server.server_close()
+
+
+def run_scaled_benchmarks(count, repeat, latency, pattern):
+    """
+    Runs all benchmarks matching the pattern in a synthetic tree with the
+    given number of stacks and returns their median durations.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='schoolappserver-benchmark-') as root, \
+            synthetic_environment(root, count, latency) as (apps, docker_client, engine_client):
+        for name, (function, setup) in scaled_benchmarks(apps, docker_client, engine_client).items():
+            if fnmatch.fnmatch(name, pattern):
+                results[name] = measure(function, setup, repeat)
+    return results
+
+
+def run_benchmarks(counts, repeat, latency, pattern):
+    """
+    Runs all benchmarks matching the pattern for every number of stacks in a
+    synthetic tree and returns the median durations by benchmark and number
+    of stacks.
+    """
+    results = {}
+    for count in counts:
+        for name, duration in run_scaled_benchmarks(count, repeat, latency, pattern).items():
+            results.setdefault(name, {})[str(count)] = duration
+    for name, (function, setup) in fixed_benchmarks().items():
+        if fnmatch.fnmatch(name, pattern):
+            results[name] = {'-': measure(function, setup, repeat)}
+    return results
+
+
+def output_results(results, counts, baseline=None, tolerance=0.25):
+    """
+    Outputs the median durations of all benchmarks in milliseconds. If a
+    baseline is given, every result that is slower than the baseline by more
+    than the tolerance is marked. Returns the number of regressions.
+    """
+    columns = [str(count) for count in counts]
+    print(f'{"benchmark [ms]":<40}' + ''.join(f'{count + " stacks":>14}' for count in columns))
+    regressions = 0
+    for name, durations in results.items():
+        cells = []
+        for column in columns if '-' not in durations else ['-']:
+            duration = durations[column] * 1000
+            cell = f'{duration:.1f}'
+            previous = (baseline or {}).get(name, {}).get(column)
+            if previous:
+                ratio = durations[column] / previous
+                cell += f' ({ratio:.2f}x)'
+                if ratio > 1 + tolerance:
+                    cell += ' !'
+                    regressions += 1
+            cells.append(f'{cell:>14}')
+        print(f'{name:<40}' + ''.join(cells))
+    return regressions
+
+
+def parse_arguments():
+    """Parses command line arguments and return the given arguments."""
+    parser = ArgumentParser(description='Benchmarks for the hot paths of SchoolAppServer.')
+    parser.add_argument('-s', '--stacks', default='29,100,500',
+                        help='comma separated numbers of stacks in the synthetic tree')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='number of executions of every benchmark')
+    parser.add_argument('-l', '--latency', type=float, default=0.05,
+                        help='simulated latency of every call to Docker in seconds')
+    parser.add_argument('-o', '--only', default='*', metavar='PATTERN',
+                        help='only run benchmarks whose name matches the glob pattern')
+    parser.add_argument('--save', metavar='FILE', help='save results as JSON file')
+    parser.add_argument('--compare', metavar='FILE', help='compare results with a saved JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown compared to the saved results (0.25 = 25 %%)')
+    return parser.parse_args()
+
+
+def main():
+    """Runs all benchmarks and outputs the results."""
+    args = parse_arguments()
+    counts = [int(count) for count in args.stacks.split(',')]
+    results = run_benchmarks(counts, args.repeat, args.latency, args.only)
+    startup_results, needless_imports = run_startup_benchmarks(args.repeat, args.only)
+    results.update(startup_results)
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    regressions = output_results(results, counts, baseline, args.tolerance)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    for name, modules in needless_imports.items():
+        if modules:
+            print(f'\n{name} imports modules it does not need: {", ".join(modules)}')
+            regressions += 1
+    if regressions:
+        print(f'\n{regressions} benchmarks are slower than allowed by the tolerance or import needless modules.')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,133 +5,28 @@ Configures and prepares Docker Compose scripts to setup a schools app server.
 For a list of provided services, see README file.
 """
 
-import re
-import os
 import sys
-import string
-import secrets
-try:
-    import tomllib
-except ModuleNotFoundError:
-    # fall back if Python version does not include tomllib
-    import tomli as tomllib
-import fileinput
-import logging
-import logging.handlers
-from pathlib import Path
-from argparse import ArgumentParser
-
-# save Python's print function, so it can be overwritten by the one from prompt_toolkit
-python_print = print
-
-import yaml
-import bcrypt
-from argon2 import PasswordHasher
-from python_on_whales import DockerClient
-from python_on_whales.exceptions import DockerException
-from prompt_toolkit.key_binding import KeyBindings
-from prompt_toolkit.shortcuts import checkboxlist_dialog, yes_no_dialog
-from prompt_toolkit.styles import Style
-from prompt_toolkit.history import FileHistory
-from prompt_toolkit.completion import NestedCompleter
-from prompt_toolkit.auto_suggest import AutoSuggestFromHistory
-from prompt_toolkit.validation import Validator
-from prompt_toolkit import print_formatted_text as print
-from prompt_toolkit import PromptSession, prompt, HTML
-
-
-# create logger instance
-logger = logging.getLogger('school_app_server')
-
-APP = 'SchoolAppServer'
-VERSION = '2.0'
-INITIAL_SETUP_MARKER_FILE = '.initialized'
-ENV_FILE_TEMPLATE_FILENAME = '.env.template'
-EXAMPLE_MAIL_PLACEHOLDER = 'mail@example.com'
-
-SUBDOMAIN_MAP = {
-    'UPTIMEKUMA_DOMAIN': 'status',
-    'TRAEFIK_DASHBOARD_DOMAIN': 'dashboard',
-    'TRAEFIK_METRICS_DOMAIN': 'metrics',
-    'PORTAINER_DOMAIN': 'portainer',
-    'NEXTCLOUD_DOMAIN': 'nextcloud',
-    'KANBOARD_DOMAIN': 'kanboard',
-    'STIRLINGPDF_DOMAIN': 'pdf',
-    'MOODLE_DOMAIN': 'moodle',
-    'HEIMDALL_DOMAIN': 'www',
-    'HOMER_DOMAIN': 'homer',
-    'DEFAULTPAGE_DOMAIN': 'static',
-    'ETHERPAD_DOMAIN': 'pad',
-    'HEDGEDOC_DOMAIN': 'md',
-    'DRAWIO_DOMAIN': 'draw',
-    'ONLYOFFICE_DOMAIN': 'onlyoffice',
-    'JENKINS_DOMAIN': 'jenkins',
-    'GITEA_DOMAIN': 'git',
-    'WEKAN_DOMAIN': 'wekan',
-    'OPENCART_DOMAIN': 'opencart',
-    'PHPMYADMIN_DOMAIN': 'phpmyadmin',
-    'JUPYTER_DOMAIN': 'jupyter',
-    'COLLABORA_DOMAIN': 'collabora',
-    'COLLABORA_NEXTCLOUD_DOMAIN': 'nextcloud',
-    'MATTERMOST_DOMAIN': 'mm',
-    'NODE_RED_DOMAIN': 'nodered',
-    'VAULTWARDEN_DOMAIN': 'vaultwarden',
-    'TEAMMAPPER_DOMAIN': 'teammapper',
-    'GRAFANA_DOMAIN': 'grafana',
-    'INFLUX_DOMAIN': 'influx',
-    'CHRONOGRAF_DOMAIN': 'chronograf',
-    'PROMETHEUS_DOMAIN': 'prometheus',
-    'LOKI_DOMAIN': 'loki',
-    'ALLOY_DOMAIN': 'alloy',
-    'AUTHENTIK_DOMAIN': 'auth',
-    'KIWIX_DOMAIN': 'kiwix',
-    'HESK_DOMAIN': 'hesk',
-    'DASHY_DOMAIN': 'dash',
-    'STALWART_DOMAIN': 'mail',
-    'STALWART_BASE_DOMAIN': '',
-    'IMMICH_DOMAIN': 'images'
-}
+import time
+from collections import namedtuple
+from argparse import ArgumentParser, REMAINDER
+
+from appserver.common import (APP, HTML, VERSION, app_name_map, check_if_initial_setup_completed, create_logger,
+                              get_short_error_message, load_answers, load_basic_configuration, logger, print_formatted,
+                              record_event, runtime, select_apps, timed_step)
+from appserver.compose_files import get_compose_index
+from appserver.configuration import do_initial_basic_setup, do_initial_setup_for_apps
+from appserver.docker_engine import (ContainerStatusCache, DOCKER_BACKENDS, DockerClientRegistry, get_docker_errors,
+                                     get_docker_reader)
+from appserver.status import get_status_format, output_report, output_status, serve_metrics
+from appserver.planning import plan_apps
+from appserver.operations import (compose_up_service, pull_app, pull_apps, restart_app, restart_apps, start_app,
+                                  start_apps, stop_app, stop_apps, update_apps)
+
 
-app_name_map = {'infrastructure': 'Infrastructure Services (Traefik, Portainer, Uptime Kuma, Watchtower)',
-                'identity-provider': 'Authentik - An open-source identity provider and user management',
-                'grafana': 'Grafana - Create, explore, and share data through beautiful, flexible dashboards',
-                'nextcloud': 'Nextcloud - Self hosted open source cloud file storage',
-                'kanboard': 'Kanboard - Free and open source Kanban project management software',
-                'moodle': 'Moodle - Open Source Learning Management System',
-                'etherpad': 'Etherpad - Real-time collaborative editor for the web',
-                'hedgedoc': 'HedgeDoc - An open-source, web-based, self-hosted, collaborative markdown editor',
-                'drawio': 'draw.io - Web-based application for creating diagrams and flowcharts',
-                'jenkins': 'Jenkins - An open source automation server for CI/CD',
-                'gitea': 'Gitea - Open Source Self-Hosted Git Service', 'wekan': 'WeKan - Open-Source Kanban',
-                'jupyter-lab': 'Jupyter Notebook Scientific Python Stack',
-                'node-red': 'Node-RED - Low-code programming for event-driven applications',
-                'collabora': 'Collabora Online Development Edition - A online office suite',
-                'onlyoffice': 'OnlyOffice - A free and open source office and productivity suite',
-                'teammapper': 'TeamMapper - Online tool to create and collaborate on mindmaps',
-                'mattermost': 'Mattermost - Open-source, self-hostable online chat service with file sharing',
-                'vaultwarden': 'Vaultwarden - Community driven web-based Bitwarden compatible password manager server',
-                'kiwix': 'Kiwix - Provides offline access to free educational content',
-                'hesk': 'Help Desk Software HESK',
-                'tools': 'Tools (Stirling PDF)', 'static': 'Landing Pages (Heimdall, Homer)',
-                'dashy': 'Dashy - A self-hostable personal dashboard built for you',
-                'opencart': 'OpenCart - Open Source Shopping Cart Solution (not yet working!)',
-                'phpmyadmin': 'phpMyAdmin - Web interface for MySQL and MariaDB (not yet working!)',
-                'stalwart': 'Stalwart - All-in-one Mail & Collaboration server supporting every protocol',
-                'immich': 'Immmich - High performance self-hosted photo and video management solution.'}
-
-basic_configuration = {}
-
-
-def create_logger():
-    """Creates and configures a logger for logging to file and stdout."""
-    logger.setLevel(logging.DEBUG)
-    log_to_file = logging.handlers.RotatingFileHandler(
-        'SchoolAppServer.log', maxBytes=262144, backupCount=5)
-    log_to_file.setLevel(logging.DEBUG)
-    logger.addHandler(log_to_file)
-    log_to_screen = logging.StreamHandler(sys.stdout)
-    log_to_screen.setLevel(logging.WARN)
-    logger.addHandler(log_to_screen)
+# options of commands for apps given on the command line or in the interactive interface
+CommandOptions = namedtuple('CommandOptions', ['force', 'ignore_memory', 'interactive'])
+# a command for apps with the past participle used when asking for apps and its handler
+AppCommand = namedtuple('AppCommand', ['verb', 'handler'])
 
 
 def parse_arguments():
@@ -139,14 +34,72 @@ def parse_arguments():
     parser = ArgumentParser(description='Administrative tool for SchoolAppServer.')
     parser.add_argument('-i', '--initial-setup', action='store_true',
                         help='set up all initial configuration and secret files')
+    parser.add_argument('-a', '--answers', metavar='FILE',
+                        help='TOML file with answers for all questions asked during setup')
+    parser.add_argument('-w', '--workers', type=int, metavar='N',
+                        help='maximum number of stacks that are handled concurrently')
+    parser.add_argument('-b', '--backend', choices=DOCKER_BACKENDS,
+                        help='backend for querying containers and images: docker CLI or Docker Engine API')
     parser.add_argument('-v', '--version', action='version',
                         version=f'{APP} {VERSION}')
+    parser.add_argument('command', nargs=REMAINDER,
+                        help='command to execute without starting the interactive interface, '
+                             'e.g. "start nextcloud moodle", "status --format json" or "pull all"')
     args = parser.parse_args()
     return args
 
 
+def build_completer():
+    """
+    Builds the completer for all commands. If the status cache is available,
+    only stacks with running containers are suggested for the command "stop".
+    """
+    from prompt_toolkit.completion import NestedCompleter  # pylint: disable=import-outside-toplevel
+    app_list = {k: None for k, v in app_name_map.items()}
+    app_list.update({'all': None})
+    running_app_list = app_list
+    if runtime.status_cache and runtime.status_cache.is_populated():
+        running_app_list = {app: None for app in runtime.status_cache.get_running_stacks()}
+        running_app_list.update({'all': None})
+    service_list = {}
+    for app in app_name_map:
+        entry = get_compose_index().get(app)
+        if entry:
+            service_list.update({f'{app}/{service}': None for service in entry['services']})
+    return NestedCompleter.from_nested_dict({
+        'start': {**app_list, **service_list},
+        'stop': {**running_app_list, **service_list},
+        'restart': {**running_app_list, **service_list},
+        'pull': app_list,
+        'update': app_list,
+        'plan': app_list,
+        'help': None,
+        'setup': app_list,
+        'status': {'--format': {'text': None, 'json': None, 'prometheus': None}},
+        'report': app_list,
+        'exit': None,
+    })
+
+
+def build_toolbar_text():
+    """Builds the text for the bottom toolbar including the number of healthy stacks."""
+    toolbar_text = '<b>Commands:</b>  -  '
+    toolbar_text += 'start [app] - stop [app] - restart [app] - pull [app] - update [app] - status - setup [app]'
+    toolbar_text += ' - help - exit - ctrl+c to quit'
+    if runtime.status_cache and runtime.status_cache.is_populated():
+        healthy, total = runtime.status_cache.count_healthy_stacks()
+        toolbar_text += f'  -  <b>{healthy}/{total} stacks healthy</b>'
+    return HTML(toolbar_text)
+
+
 def prepare_cli_interface():
     """Sets up style, key bindings and autocompletion for command line interface."""
+    from prompt_toolkit import PromptSession  # pylint: disable=import-outside-toplevel
+    from prompt_toolkit.key_binding import KeyBindings  # pylint: disable=import-outside-toplevel
+    from prompt_toolkit.styles import Style  # pylint: disable=import-outside-toplevel
+    from prompt_toolkit.history import FileHistory  # pylint: disable=import-outside-toplevel
+    from prompt_toolkit.completion import DynamicCompleter  # pylint: disable=import-outside-toplevel
+    from prompt_toolkit.auto_suggest import AutoSuggestFromHistory  # pylint: disable=import-outside-toplevel
     bindings = KeyBindings()
 
     @bindings.add('c-x')
@@ -158,410 +111,280 @@ def prepare_cli_interface():
         'path':   'ansicyan',
         'bottom-toolbar': '#444444 bg:#ffcc00'
     })
-    app_list = {k: None for k, v in app_name_map.items()}
-    app_list.update({'all': None})
-    completer = NestedCompleter.from_nested_dict({
-        'start': app_list,
-        'stop': app_list,
-        'pull': app_list,
-        'help': None,
-        'setup': app_list,
-        'status': None,
-        'exit': None,
-    })
     command_history = FileHistory(".schoolappserver_history")
-    toolbar_text = '<b>Commands:</b>  -  '
-    toolbar_text += 'start [app] - stop [app] - pull [app] - status - setup [app] - help - exit - ctrl+c to quit'
-    toolbar_text = HTML(toolbar_text)
-    session = PromptSession(auto_suggest=AutoSuggestFromHistory(), style=style, completer=completer,
-                            history=command_history, key_bindings=bindings, bottom_toolbar=toolbar_text,
-                            complete_while_typing=True)
+    session = PromptSession(auto_suggest=AutoSuggestFromHistory(), style=style,
+                            completer=DynamicCompleter(build_completer), history=command_history,
+                            key_bindings=bindings, bottom_toolbar=build_toolbar_text, complete_while_typing=True)
     return session
 
 
-def create_password(length=25):
+def show_help_info():
+    """Show help page with information about available commands."""
+    help_lines = [
+        f'<skyblue>{APP}</skyblue> <violet>{VERSION}</violet>',
+        '<orange>start [app ...]</orange>   - Start stacks not yet running with current config (--force for all).',
+        '                    Stacks that do not fit into memory are refused (--ignore-memory to start them).',
+        '<orange>stop [app ...]</orange>    - Stop one, several or all Docker Compose stacks.',
+        '<orange>restart [app ...]</orange> - Restart one, several or all Docker Compose stacks.',
+        '<orange>pull [app ...]</orange>    - Pull images of one, several or all Docker Compose stacks.',
+        '<orange>update [app ...]</orange>  - Pull images and recreate changed services one by one.',
+        '<orange>plan [app ...]</orange>    - Show what setup, start and update would change (dry run).',
+        '<orange>status [--format f]</orange> - Show status of all stacks (text, json, prometheus).',
+        '<orange>setup [app ...]</orange>   - Set up or update configuration files (--force to regenerate).',
+        '<orange>report [app ...]</orange>  - Show p50/p95 durations of all recorded operations and steps.',
+        '<orange>help</orange>              - Show this list of commands.',
+        '<orange>exit</orange>              - Exit the programm.',
+        'Apps can be given as names, glob patterns like "grafana*" or exclusions like "!jupyter-lab".',
+        'Single services can be started, stopped and restarted with "app/service", '
+        'e.g. "restart nextcloud/nextcloud".',
+        'All commands can also be given on the command line, e.g. "school_app_server.py start nextcloud".',
+        'The metrics exporter for Prometheus is started on the command line with '
+        '"school_app_server.py exporter [--listen host:port]".',
+    ]
+    for line in help_lines:
+        print_formatted(HTML(line))
+
+
+def select_services(args):
+    """
+    Splits the given arguments into names of apps and services given as
+    "app/service". Returns the remaining arguments and a list of all services
+    as tuples of app and service. If an unknown service is given, None is
+    returned instead of the list of services.
     """
-    Creates a secure password of a given length. The password should contain at
-    least one lower case character, one upper case character and one digit.
+    remaining_args, services, unknown_services = [], [], []
+    for arg in args:
+        if '/' not in arg:
+            remaining_args.append(arg)
+            continue
+        app, service = arg.split('/', 1)
+        entry = get_compose_index().get(app) if app in app_name_map else None
+        if entry and service in entry['services']:
+            services.append((app, service))
+        else:
+            unknown_services.append(arg)
+    if unknown_services:
+        print_formatted(HTML('<red>Given service not available: {}</red>').format(', '.join(unknown_services)))
+        return remaining_args, None
+    return remaining_args, services
+
 
-    Source: https://docs.python.org/3/library/secrets.html#recipes-and-best-practices
+def control_service(docker_clients, command, app, service):
     """
-    alphabet = string.ascii_letters + string.digits
-    while True:
-        password = ''.join(secrets.choice(alphabet) for i in range(length))
-        if (any(c.islower() for c in password) and
-            any(c.isupper() for c in password) and
-                any(c.isdigit() for c in password)):
-            break
-    return password
+    Starts, stops or restarts a single service of a Docker stack without
+    touching any other service of the stack.
+    """
+    action = {'start': 'Starting', 'stop': 'Stopping', 'restart': 'Restarting'}[command]
+    print_formatted(f' *** {action} service {service} of app {app} *** ')
+    start_time = time.monotonic()
+    try:
+        docker_client = docker_clients[app]
+        if command == 'start':
+            compose_up_service(docker_client, service, pull='missing')
+        elif command == 'stop':
+            docker_client.compose.stop(services=[service])
+        else:
+            docker_client.compose.restart(services=[service])
+    except FileNotFoundError as e:
+        print_formatted(HTML('<red>{}</red>').format(e))
+        return False
+    except get_docker_errors() as e:
+        logger.debug('Could not %s service %s of app %s: %s', command, service, app, e)
+        print_formatted(HTML(' ❌ {}/{} - <red>{}</red>').format(app, service, get_short_error_message(e)))
+        record_event(command, app, time.monotonic() - start_time, False, service=service)
+        return False
+    record_event(command, app, time.monotonic() - start_time, service=service)
+    return True
 
 
-def find_all_secrets():
-    """Iterates over the Docker Compose files of each stack and finds all secrets defined there."""
-    all_secrets = []
-    for path in Path('.').glob('*/docker-compose.yml'):
-        data = yaml.safe_load(path.open())
-        if 'secrets' in data:
-            all_secrets.extend([(str(path.parent), data['secrets'][s]['file']) for s in data['secrets']])
-    return all_secrets
+def ask_for_apps(title, text, interactive):
+    """Asks the user which apps should be used for a command. Returns None in non-interactive mode."""
+    if not interactive:
+        print_formatted(HTML('<red>Please give the name of at least one app or "all"!</red>'))
+        return None
+    from prompt_toolkit.shortcuts import checkboxlist_dialog  # pylint: disable=import-outside-toplevel
+    return checkboxlist_dialog(title=title, text=text, values=list(app_name_map.items())).run()
 
 
-def generate_htpasswd_bcrypt(username, password):
-    """
-    Generates a htpasswd entry by calculating the bcrypt hash of a given
-    password and append it to the username.
+def start_command(docker_clients, apps, options):
+    """Starts the given apps. A single app is started without timing report."""
+    if len(apps) == 1:
+        return start_app(docker_clients, apps[0], force=options.force, ignore_memory=options.ignore_memory)
+    return start_apps(docker_clients, apps, force=options.force, ignore_memory=options.ignore_memory)
 
-    Sources:
-     - https://www.toor.su/posts/2019/06/htpasswd-with-bcrypt/
-     - https://gist.github.com/zobayer1/d86a59e45ae86198a9efc6f3d8682b49
-    """
-    # generating on command line: printf "admin:$(openssl passwd -apr1 {chosen_password})\n" > traefik_dashboard_auth
-    bcrypted = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=12)).decode('utf-8')
-    return f'{username}:{bcrypted}'
 
+def stop_command(docker_clients, apps, _options):
+    """Stops the given apps. A single app is stopped without timing report."""
+    if len(apps) == 1:
+        return stop_app(docker_clients, apps[0])
+    return stop_apps(docker_clients, apps)
 
-def generate_argon_password_hash(password):
-    """
-    Generate a hashed password with argon2 in PHC string format used by Vaultwarden for example.
 
-    Sources:
-     - https://github.com/dani-garcia/vaultwarden/wiki/Enabling-admin-page#secure-the-admin_token 
-     - https://github.com/P-H-C/phc-string-format/blob/master/phc-sf-spec.md
+def restart_command(docker_clients, apps, _options):
+    """Restarts the given apps. A single app is restarted without timing report."""
+    if len(apps) == 1:
+        return restart_app(docker_clients, apps[0])
+    return restart_apps(docker_clients, apps)
 
-    The gennerated hash should look like this:
-    $argon2id$v=19$m=65540,t=3,p=4$bXBGMENBZUVzT3VUSFErTzQzK25Jck1BN2Z0amFuWjdSdVlIQVZqYzAzYz0$T9m73OdD...
-    """
-    ph = PasswordHasher(time_cost=3, memory_cost=65540, parallelism=4, hash_len=32, salt_len=32)
-    return ph.hash(password)
 
+def pull_command(docker_clients, apps, options):
+    """Pulls the images of the given apps."""
+    if len(apps) == 1:
+        return pull_app(docker_clients, apps[0])
+    return pull_apps(docker_clients, apps, options.interactive)
 
-def create_secret_files(given_app):
-    """
-    Creates all files with secrets referenced in the Docker Compose files and
-    fill them with long passwords for a given app.
-    """
-    for app, filename in find_all_secrets():
-        if app != given_app:
-            continue
-        filepath = Path(app) / filename
-        if 'dashboard_auth' in filename:
-            chosen_password = create_password()
-            print(f'Generated htpasswd password for Traefik Dashboard (user "admin"): {chosen_password}')
-            print('Please save this password for later use!')
-            with open(filepath, 'w', encoding='utf-8') as f:
-                f.write(generate_htpasswd_bcrypt('admin', chosen_password))
-                logger.debug('Writing HTTP auth string to file: %s', filename)
-        elif 'chronograf_htpasswd_auth' in filename:
-            chosen_password = create_password()
-            print(f'Generated htpasswd password for Chronograf (user "admin"): {chosen_password}')
-            print('Please save this password for later use!')
-            with open(filepath, 'w', encoding='utf-8') as f:
-                f.write(generate_htpasswd_bcrypt('admin', chosen_password))
-                logger.debug('Writing HTTP auth string to file: %s', filename)
-        elif 'smtp_password' in filename:
-            # handle SMTP password files
-            with open(filepath, 'w', encoding='utf-8') as f:
-                smtp_password = prompt('Please enter the SMTP password: ', is_password=True)
-                f.write(smtp_password)
-                logger.debug('Writing SMTP password to file: %s', filename)
-        elif 'telegram' in filename:
-            # handle telegram URL files
-            with open(filepath, 'w', encoding='utf-8') as f:
-                bot_id = prompt('Please enter the Telegram bot id: ')
-                bot_id = '[bot_id]' if not bot_id else bot_id
-                chat_id = prompt('Please enter the Telegram chat id: ')
-                chat_id = '[chat_id]' if not chat_id else chat_id
-                url = f'telegram://{bot_id}@telegram/?channels={chat_id}'
-                f.write(url)
-                logger.debug('Writing Telegram IDs to file: %s', filename)
-        else:
-            # handle all other files by just filling them with a long password
-            with open(filepath, 'w', encoding='utf-8') as f:
-                f.write(create_password())
-                logger.debug('Writing password to secrets file: %s', filename)
-
-
-def replace_string_in_file(filename, old_string, new_string):
-    """Replaces a string in a given file (https://stackoverflow.com/a/20593644)"""
-    with fileinput.FileInput(Path(filename), inplace=True, backup='.bak') as file:
-        for line in file:
-            python_print(line.replace(old_string, new_string), end='')
-
-
-def replace_mail_address_in_files(mail_address):
-    """Replaces a given mail address in all configuration files."""
-    for path in Path('.').glob('*/*.yml'):
-        if path.is_file():
-            with open(path, 'r', encoding='utf-8') as file:
-                if EXAMPLE_MAIL_PLACEHOLDER in file.read():
-                    logger.debug('Found mail address to be replaced: %s', path)
-                    replace_string_in_file(path, EXAMPLE_MAIL_PLACEHOLDER, mail_address)
-
-
-def do_initial_basic_setup():
-    """Initializes basic configuration."""
-    print(' *** Initializing basic configuration *** ')
-    # input all information from user
-    mail_validator = Validator.from_callable(
-        # do a very simple check for validity (https://stackoverflow.com/a/8022584)
-        lambda text: re.match(r'[^@]+@[^@]+\.[^@]+', text),
-        error_message="Not a valid e-mail address!",
-        move_cursor_to_end=True,
-    )
-    domain_validator = Validator.from_callable(
-        lambda text: re.match(r'\w+\.\w+', text),
-        error_message="Not a valid domain name!",
-        move_cursor_to_end=True,
-    )
-    mail_address = prompt('Please enter your mail address: ', validator=mail_validator)
-    # get base domain name (for non-ASCII characters in domain names, punycode has to used!)
-    # Source: https://doc.traefik.io/traefik/routing/routers/#host-and-hostregexp
-    domain_prompt = 'Please enter your domain name (third-level domain will be added, e.g. nicedomain.com): '
-    domain_name = prompt(domain_prompt, validator=domain_validator)
-    # write basic configuration to file
-    with open(Path(INITIAL_SETUP_MARKER_FILE), 'w', encoding='utf-8') as f:
-        f.write(f'mail-address = "{mail_address}"\ndomain-name = "{domain_name}"\n')
-        logger.debug('Writing basic configuration to file: %s', INITIAL_SETUP_MARKER_FILE)
-    replace_mail_address_in_files(mail_address)
-    # set correct file permissions for acme.json in app 'infrastructure'
-    os.chmod(Path('infrastructure') / 'acme.json', 0o600)
-
-
-def generate_env_file_from_template(app):
-    """
-    Generate a file with all environment variables from a template
-    (.env.template) and fill in all missing element, like specific domain
-    names, passwords, SMTP parameters, etc.
-    """
-    parameters = {}
-    # find all env variables that contain domain names and generate them
-    with open(Path(app) / ENV_FILE_TEMPLATE_FILENAME, 'r', encoding='utf-8') as f:
-        template = f.read()
-    for line in template.strip().split('\n'):
-        if not line.strip():
-            # skip empty lines
-            continue
-        var_name, _ = line.split('=')
-        if 'DOMAIN' in var_name:
-            app_domain_name = f'{SUBDOMAIN_MAP[var_name]}.{basic_configuration["domain-name"]}'
-            app_domain_key = var_name.lower()
-            parameters[app_domain_key] = app_domain_name
-    # get all placeholders that are not domain from string  (https://stackoverflow.com/a/14061832)
-    parameter_names = [name for text, name, spec, conv in string.Formatter().parse(
-        template) if name is not None]
-    # filter missing parameters and input them from user
-    parameter_names = set(parameter_names)
-    for p in parameter_names:
-        if 'domain' in p:
-            # skip parameters that have been filled already (see above)
-            continue
-        cleaned_up_p = p.replace('_', ' ')
-        if 'password' in p or 'token' in p:
-            print('This seems to be a password or token, so a random secure value is suggested.')
-            parameters[p] = prompt(f'Please enter parameter "{cleaned_up_p}": ', default=create_password())
-        else:
-            parameters[p] = prompt(f'Please enter parameter "{cleaned_up_p}": ')
-        if 'vaultwarden_admin_token' == p:
-            print(f'Generating argon2 password hash for password {parameters[p]}.')
-            # write hashed password to .env file and put single quotation marks around it
-            parameters[p] = f"'{generate_argon_password_hash(parameters[p])}'"
-    filename = Path(app, '.env')
-    print(f'Writing environment variables to file: {filename}')
-    logger.debug('Writing env vars to file: %s', filename)
-    with open(filename, 'w', encoding='utf-8') as f:
-        f.write(template.format(**parameters))
-    # mark single app directories as initialized
-    (Path(app) / INITIAL_SETUP_MARKER_FILE).touch()
-
-
-def do_initial_setup_for_app(given_app):
-    """
-    Initializes all environment variables from a template file (.env.template)
-    and fill all missing element, like specific domain names, passwords, SMTP
-    parameters, etc. Also all necessary secret files will be created and filled
-    with a random and secure password.
-    """
-    print(f' *** Initializing app configuration for {given_app} *** ')
-    create_secret_files(given_app)
-    generate_env_file_from_template(given_app)
-
-
-def output_status(docker_clients):
-    """Outputs status information about all stacks and their respective containers."""
-    print(' *** Stacks and Container *** \n')
-    for app, docker in docker_clients.items():
-        if check_if_initial_setup_completed(app):
-            container = docker.compose.ps(all=True)
-            mark = '✔️' if container else '❌'
-            print(f' {mark} {app_name_map[app]} {"⣿" * len(container)}')
-            for c in container:
-                print(f'    - {c.name}')
-        else:
-            print(HTML(f' ❌ {app_name_map[app]} - <style color="#ffcc00">Not yet initialized!</style>'))
 
+def update_command(docker_clients, apps, options):
+    """Updates the given apps service by service."""
+    return update_apps(docker_clients, apps, options.interactive)
 
-def start_app(docker_clients, app):
-    """Starts all containers of a specific Docker stack."""
-    print(f' *** Starting app {app} *** \n')
-    if not check_if_initial_setup_completed(app):
-        do_initial_setup_for_app(app)
-    try:
-        docker_client = docker_clients[app]
-        docker_client.compose.up(services=None, build=False, detach=True, pull='missing')
-    except DockerException:
-        print('Could not start app. Maybe you have not started the app "infrastructure" first?')
 
+def setup_command(_docker_clients, apps, options):
+    """Sets up the given apps, all files are regenerated with "--force"."""
+    return do_initial_setup_for_apps(apps, force=options.force)
 
-def stop_app(docker_clients, app):
-    """Stops all containers of a specific Docker stack."""
-    if check_if_initial_setup_completed(app):
-        print(f' *** Stopping app {app} *** \n')
-        docker_client = docker_clients[app]
-        docker_client.compose.down()
 
+def plan_command(_docker_clients, apps, _options):
+    """Shows the pending changes of the given apps."""
+    with timed_step('plan', apps=len(apps)):
+        return plan_apps(apps)
 
-def pull_app(docker_clients, app):
-    """Pulls all containers of a specific Docker stack."""
-    print(f' *** Pulling app {app} *** \n')
-    if check_if_initial_setup_completed(app):
-        docker_client = docker_clients[app]
-        docker_client.compose.pull()
 
+APP_COMMANDS = {
+    'start': AppCommand('started', start_command),
+    'stop': AppCommand('stopped', stop_command),
+    'restart': AppCommand('restarted', restart_command),
+    'pull': AppCommand('pulled', pull_command),
+    'update': AppCommand('updated', update_command),
+    'setup': AppCommand('set up', setup_command),
+    'plan': AppCommand('planned', plan_command),
+}
 
-def check_if_initial_setup_completed(app=None):
-    """Checks whether initial setup has been executed."""
-    if app:
-        if (Path(app) / INITIAL_SETUP_MARKER_FILE).is_file():
-            return True
-    else:
-        if Path(INITIAL_SETUP_MARKER_FILE).is_file():
+
+def status_command(args):
+    """Outputs the status of all stacks in the format given as arguments."""
+    output_format = get_status_format(args)
+    if output_format is None:
+        return False
+    with timed_step('status', format=output_format):
+        return output_status(output_format)
+
+
+def basic_setup_command(interactive):
+    """Executes the initial basic setup, in interactive mode only after asking the user."""
+    if interactive:
+        if check_if_initial_setup_completed():
+            text = 'The initial basic setup has already been executed. Do you want to run it again?'
+            title_text = 'Run initial setup again?'
+        else:
+            text = 'Do you really want to run the initial basic setup?'
+            title_text = 'Run initial setup for all apps?'
+        from prompt_toolkit.shortcuts import yes_no_dialog  # pylint: disable=import-outside-toplevel
+        if not yes_no_dialog(title=title_text, text=text).run():
             return True
-    return False
+    if not do_initial_basic_setup():
+        return False
+    load_basic_configuration()
+    return True
 
 
-def show_help_info():
-    """Show help page with information about available commands."""
-    print(HTML(f'<skyblue>{APP}</skyblue> <violet>{VERSION}</violet>'))
-    print(HTML('<orange>start [app]</orange> - Start one or all Docker Compose stack.'))
-    print(HTML('<orange>stop [app]</orange>  - Stop one or all Docker Compose stack.'))
-    print(HTML('<orange>pull [app]</orange>  - Stop one or all Docker Compose stack.'))
-    print(HTML('<orange>status</orange>      - Show status of all Docker Compose stacks.'))
-    print(HTML('<orange>setup [app]</orange> - Execute initial set up of configuration files.'))
-    print(HTML('<orange>help</orange>        - Show this list of commands.'))
-    print(HTML('<orange>exit</orange>        - Exit the programm.'))
-
-
-def load_basic_configuration():
-    """Loads basic configuration from file."""
-    try:
-        with open(Path(INITIAL_SETUP_MARKER_FILE), 'rb') as f:
-            global basic_configuration
-            basic_configuration = tomllib.load(f)
-    except FileNotFoundError:
-        logger.debug('Could not find basic configuration file.')
+def evaluate_app_command(docker_clients, command, args, interactive):
+    """
+    Evaluates a command for apps and services given as arguments. If no app
+    is given, the user is asked for the apps in interactive mode.
+    """
+    # regenerate all configuration and secret files with "setup [app] --force"
+    options = CommandOptions(force='--force' in args, ignore_memory='--ignore-memory' in args, interactive=interactive)
+    args = [arg for arg in args if arg not in ('--force', '--ignore-memory')]
+    if command == 'setup' and not args:
+        return basic_setup_command(interactive)
+    services = []
+    if command in ('start', 'stop', 'restart'):
+        args, services = select_services(args)
+        if services is None:
+            return False
+    # a list instead of a generator, so that all services are handled even if one of them fails
+    success = all([control_service(docker_clients, command, app, service)  # pylint: disable=use-a-generator
+                   for app, service in services])
+    if services and not args:
+        return success
+    if command == 'plan' and not args:
+        args = ['all']
+    verb, handler = APP_COMMANDS[command]
+    if args:
+        apps = select_apps(args)
+    else:
+        apps = ask_for_apps(f'{command.capitalize()} apps', f'Which apps should be {verb}?', interactive)
+    if apps is None:
+        return False
+    if apps:
+        success = handler(docker_clients, apps, options) and success
+    return success
 
 
-def evaluate_command(docker_clients, command, args):
+def evaluate_command(docker_clients, command, args, interactive=True):
     """
     Evaluates the given command and executes it. Can be called from the
-    commandline or as command from inside SchoolAppServer.
+    commandline or as command from inside SchoolAppServer. Returns whether
+    the command was executed successfully.
     """
     if command == 'status':
-        output_status(docker_clients)
-    elif command == 'start':
-        if args:
-            # TODO: Handle multiple given app names instead of just on app.
-            if args[0] in app_name_map:
-                start_app(docker_clients, args[0])
-            elif args[0] == 'all':
-                for app in app_name_map:
-                    start_app(docker_clients, app)
-            else:
-                print(HTML('<red>Given app not available!</red>'))
-        else:
-            results_array = checkboxlist_dialog(
-                title="Start apps", text="Which apps should be started?",
-                values=list(app_name_map.items())
-            ).run()
-            if results_array:
-                for app in results_array:
-                    start_app(docker_clients, app)
-    elif command == 'stop':
-        if args:
-            if args[0] in app_name_map:
-                stop_app(docker_clients, args[0])
-            elif args[0] == 'all':
-                for app in app_name_map:
-                    stop_app(docker_clients, app)
-            else:
-                print(HTML('<red>Given app not available!</red>'))
-        else:
-            results_array = checkboxlist_dialog(
-                title="Stop apps", text="Which apps should be stopped?",
-                values=list(app_name_map.items())
-            ).run()
-            if results_array:
-                for app in results_array:
-                    stop_app(docker_clients, app)
-    elif command == 'pull':
-        if args:
-            if args[0] in app_name_map:
-                pull_app(docker_clients, args[0])
-            elif args[0] == 'all':
-                for app in app_name_map:
-                    pull_app(docker_clients, app)
-            else:
-                print(HTML('<red>Given app not available!</red>'))
-        else:
-            results_array = checkboxlist_dialog(
-                title="Pull apps", text="Which apps should be pulled?",
-                values=list(app_name_map.items())
-            ).run()
-            if results_array:
-                for app in results_array:
-                    pull_app(docker_clients, app)
-    elif command == 'setup':
-        if args:
-            if args[0] in app_name_map:
-                do_initial_setup_for_app(args[0])
-            elif args[0] == 'all':
-                for app in app_name_map:
-                    do_initial_setup_for_app(app)
-            else:
-                print(HTML('<red>Given app not available!</red>'))
-        else:
-            if check_if_initial_setup_completed():
-                text = 'The initial basic setup has already been executed. Do you want to run it again?'
-                title_text = 'Run initial setup again?'
-            else:
-                text = 'Do you really want to run the initial basic setup?'
-                title_text = 'Run initial setup for all apps?'
-            do_run = yes_no_dialog(title=title_text, text=text).run()
-            if do_run:
-                do_initial_basic_setup()
-                load_basic_configuration()
-    else:
-        print(HTML('<red>Invalid command!</red>'))
+        return status_command(args)
+    if command == 'report':
+        return output_report(args)
+    if command not in APP_COMMANDS:
+        print_formatted(HTML('<red>Invalid command!</red>'))
+        return False
+    return evaluate_app_command(docker_clients, command, args, interactive)
+
+
+def run_command_line(command_line):
+    """
+    Executes a single command given on the command line without starting the
+    interactive command line interface. Returns the exit code for the process.
+    """
+    command, args = command_line[0], command_line[1:]
+    load_basic_configuration()
+    if command == 'help':
+        show_help_info()
+        return 0
+    if command == 'exporter':
+        return 0 if serve_metrics(args) else 1
+    if command != 'setup' and not check_if_initial_setup_completed():
+        print_formatted('Please start initial setup first by executing the command "setup"!')
+        return 1
+    docker_clients = DockerClientRegistry()
+    success = evaluate_command(docker_clients, command, args, interactive=False)
+    get_compose_index().save()
+    return 0 if success else 1
 
 
 def main():
     """Starts command line interface and waits for commands."""
-    # prepare session
-    session = prepare_cli_interface()
-    prompt_message = [('class:pound', '\n ➭ ')]
     # check for commandline arguments
     args = parse_arguments()
+    runtime.max_workers = args.workers
+    runtime.docker_backend = args.backend
+    # commands given on the command line run unattended and must not ask anything
+    runtime.interactive = not args.command
+    if args.answers:
+        load_answers(args.answers)
     if args.initial_setup:
         logger.info('Initializing all configuration and secret files...')
-        do_initial_basic_setup()
-    # prepare instances of Docker client
-    # (Python-on-Whales: https://gabrieldemarmiesse.github.io/python-on-whales/sub-commands/compose/)
-    docker_clients = {}
-    for app, _ in app_name_map.items():
-        docker = DockerClient(compose_files=[Path(app) / 'docker-compose.yml'], compose_env_file=Path(app) / '.env')
-        docker_clients[app] = docker
+        if not do_initial_basic_setup() and args.command:
+            return 1
+    if args.command:
+        return run_command_line(args.command)
+    # prepare session
+    session = prepare_cli_interface()
+    prompt_message = [('class:pound', '\n ➭ ')]
+    # instances of Docker client are created on first use
+    docker_clients = DockerClientRegistry()
     load_basic_configuration()
-    print(f'{APP} {VERSION}')
+    # watch Docker events in background to keep status information up to date
+    runtime.status_cache = ContainerStatusCache(get_docker_reader())
+    runtime.status_cache.start()
+    print_formatted(f'{APP} {VERSION}')
     while True:
         try:
             user_input = session.prompt(prompt_message)
@@ -570,17 +393,18 @@ def main():
             user_input = user_input.split()
             command, args = user_input[0], user_input[1:]
             if command in ('exit', 'quit'):
-                return
+                return 0
             if command == 'help':
                 show_help_info()
             elif command != 'setup' and not check_if_initial_setup_completed():
-                print('Please start initial setup first by entering the command "setup"!')
+                print_formatted('Please start initial setup first by entering the command "setup"!')
             else:
                 evaluate_command(docker_clients, command, args)
+                get_compose_index().save()
         except KeyboardInterrupt:
-            return
+            return 0
 
 
 if __name__ == '__main__':
     create_logger()
-    main()
+    sys.exit(main())